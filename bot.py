@@ -0,0 +1,395 @@
+import argparse
+import os
+import re
+import socket
+import threading
+import time
+import urllib.request
+from constants import *
+from connection import FrameReader, HEADER_SIZE, READ_BUFFER_SIZE, pack_datagram, unpack_datagram
+from protocol import encode, decode, BINARY_CODEC, CODECS, COMPRESSION, FULL_STATE, POSITION_SCALE, apply_delta
+from metrics import PREFIX
+
+SCRIPTS = {  # действия бота по шагам, по кругу
+    'idle': ['stay'],
+    'walk': ['walk'],
+    'mine': ['walk', 'walk', 'place', 'walk', 'walk', 'mine'],
+    'build': ['place', 'mine'],
+}
+WALK_RANGE = 12  # бот ходит туда-сюда вокруг точки появления
+WALK_SPEED = 5  # блоков в секунду
+ECHO_EVERY = 5  # шагов между замерами задержки
+DIRT_SLOT = 1  # в стартовом наборе: факелы, потом земля
+SENT_TTL = 10  # секунд хранятся времена отправки для замера рассылки
+METRICS_TIMEOUT = 2  # секунд на снятие /metrics сервера
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Stats:  # общая для всех ботов статистика
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.rtt = []
+        self.broadcast = []
+        self.edits = {}  # (x, y) -> время отправки изменения блока
+        self.moves = {}  # (id, x, y) -> время отправки пинга, координаты как в снимке
+
+    def count(self, sent=0, received=0, errors=0):
+        self.lock.acquire()
+        try:
+            self.sent += sent
+            self.received += received
+            self.errors += errors
+        finally:
+            self.lock.release()
+
+    def remember(self, table, key):
+        self.lock.acquire()
+        try:
+            table[key] = time.time()
+        finally:
+            self.lock.release()
+
+    def measure(self, values, start):
+        delay = time.time() - start
+        if delay < 0:
+            return
+        self.lock.acquire()
+        try:
+            values.append(delay)
+        finally:
+            self.lock.release()
+
+    def take(self):  # показатели с прошлого вызова
+        self.lock.acquire()
+        try:
+            res = {'sent': self.sent, 'received': self.received, 'errors': self.errors,
+                   'rtt': self.rtt, 'broadcast': self.broadcast}
+            self.sent = self.received = self.errors = 0
+            self.rtt, self.broadcast = [], []
+            old = time.time() - SENT_TTL
+            for table in [self.edits, self.moves]:
+                for key in [i for i in table if table[i] < old]:
+                    table.pop(key)
+        finally:
+            self.lock.release()
+        return res
+
+
+def parse_metrics(text):  # имя -> [(метки, значение)] из текстового формата Prometheus
+    res = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        labels = {}
+        if '{' in name:
+            name, rest = name.split('{', 1)
+            labels = dict(LABEL.findall(rest))
+        res.setdefault(name, []).append((labels, float(value)))
+    return res
+
+
+class ServerMetrics:  # пропускная способность со стороны сервера: разница двух снятий его /metrics
+    def __init__(self, host, port):
+        self.url = 'http://' + host + ':' + str(port) + '/metrics'
+        self.last = None
+
+    def scrape(self):  # (время, сообщений, обработок, секунд в обработчиках, граница корзины -> обработок)
+        metrics = parse_metrics(urllib.request.urlopen(self.url, timeout=METRICS_TIMEOUT).read().decode())
+        total = lambda name: sum(i[1] for i in metrics.get(PREFIX + name, []))
+        buckets = {}  # корзины всех обработчиков вместе
+        for labels, value in metrics.get(PREFIX + 'handler_seconds_bucket', []):
+            bound = float(labels['le'])
+            buckets[bound] = buckets.get(bound, 0) + value
+        return time.time(), total('messages_total'), total('handler_seconds_count'), total('handler_seconds_sum'), buckets
+
+    def take(self):  # показатели с прошлого вызова, None - сервер не ответил или снятие первое
+        try:
+            current = self.scrape()
+        except (OSError, ValueError) as e:
+            print('metrics:', e)
+            self.last = None
+            return None
+        last, self.last = self.last, current
+        if last is None or current[0] <= last[0]:
+            return None
+        count = current[2] - last[2]
+        p99 = 0
+        for bound in sorted(current[4]):  # верхняя граница корзины, в которую попал 99-й процентиль
+            p99 = bound
+            if current[4][bound] - last[4].get(bound, 0) >= count * 0.99:
+                break
+        return {'messages': (current[1] - last[1]) / (current[0] - last[0]),
+                'handler_mean': (current[3] - last[3]) / count if count > 0 else 0,
+                'handler_p99': p99 if count > 0 else 0}
+
+
+class Bot:  # игрок без графики: тот же протокол, что у Game.send и Game.receive
+    def __init__(self, name, host, port, script, stats, codec=BINARY_CODEC, udp=False, world=''):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.script = SCRIPTS[script]
+        self.stats = stats
+        self.codec = codec
+        self.compression = None
+        self.udp = udp
+        self.world = world
+        self.socket = None
+        self.datagram_socket = None
+        self.datagram_token = 0
+        self.datagram_sent = 0
+        self.datagram_received = 0
+        self.reader = None
+        self.send_lock = threading.Lock()
+        self.handle_lock = threading.Lock()
+        self.running = False
+        self.id = None
+        self.x = self.y = self.home = 0
+        self.direction = 1
+        self.snapshots = {}
+        self.last_snapshot = -1
+
+    def send(self, data):
+        prep = encode(data, self.codec, self.compression)
+        self.send_lock.acquire()
+        try:
+            self.socket.sendall(len(prep).to_bytes(HEADER_SIZE, 'big') + prep)
+        finally:
+            self.send_lock.release()
+        self.stats.count(sent=1)
+
+    def send_datagram(self, data):
+        self.datagram_sent += 1
+        try:
+            self.datagram_socket.send(pack_datagram(self.datagram_token, self.datagram_sent, encode(data, self.codec, self.compression)))
+        except OSError:
+            pass
+        self.stats.count(sent=1)
+
+    def connect(self):
+        self.socket = socket.create_connection((self.host, self.port))
+        self.reader = FrameReader(self.socket)
+        self.send({'request': JOIN_REQUEST, 'data': {'name': self.name, 'codecs': [self.codec], 'compression': [COMPRESSION],
+                                                     'udp': self.udp, 'world': self.world, 'view': [BASE_BLOCK_WIDTH + 20, BASE_BLOCK_HEIGHT + 20]}})
+        response = decode(self.reader.read())
+        if not response['success']:
+            raise ConnectionError(response['reason'])
+        self.codec = response['codec']
+        self.compression = response.get('compression')
+        self.id = response['id']
+        self.x = self.home = response['player_data']['x']
+        self.y = response['player_data']['y']
+        self.running = True
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+        if response.get('udp'):
+            self.datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.datagram_socket.connect((self.host, response['udp']['port']))
+            self.datagram_token = response['udp']['token']
+            threading.Thread(target=self.datagram_loop, daemon=True).start()
+        region = int(self.home) // REGION_SIZE
+        self.send({'request': REGION_REQUEST, 'data': {'load': [region - 1, region, region + 1], 'unload': []}})
+
+    def receive_loop(self):
+        try:
+            while self.running:
+                self.handle(decode(self.reader.read()))
+                self.stats.count(received=1)
+        except Exception:
+            if self.running:
+                self.stats.count(errors=1)
+            self.running = False
+
+    def datagram_loop(self):
+        while self.running:
+            try:
+                res = unpack_datagram(self.datagram_socket.recv(READ_BUFFER_SIZE))
+            except OSError:
+                return
+            if res is None or res[0] != self.datagram_token or res[1] <= self.datagram_received:
+                continue
+            self.datagram_received = res[1]
+            self.handle(decode(res[2]))
+            self.stats.count(received=1)
+
+    def handle(self, data):  # зовут и поток tcp, и поток udp: базы разностей меняются под блокировкой
+        self.handle_lock.acquire()
+        try:
+            body = data['data']
+            if data['request'] == ECHO:
+                self.stats.measure(self.stats.rtt, body['time'])
+            elif data['request'] == HANDOFF:  # роутер перевел бота на другой сервер
+                self.id = body['id']
+                self.snapshots = {}
+                self.last_snapshot = -1
+                region = int(self.x) // REGION_SIZE
+                self.send({'request': REGION_REQUEST, 'data': {'load': [region - 1, region, region + 1], 'unload': []}})
+            elif data['request'] == SNAPSHOT:
+                for source, message in body['blocks']:
+                    if source != self.id and message['request'] == BLOCK_UPDATE:
+                        start = self.stats.edits.get((message['data']['x'], message['data']['y']))
+                        if start is not None:
+                            self.stats.measure(self.stats.broadcast, start)
+                states = dict(self.snapshots.get(body['base'], {}))
+                for i in body['players']:
+                    if i['mask'] & FULL_STATE or i['id'] in states:
+                        states[i['id']] = apply_delta(states.get(i['id']), i)
+                        start = self.stats.moves.get((i['id'],) + states[i['id']][:2])
+                        if i['id'] != self.id and start is not None:
+                            self.stats.measure(self.stats.broadcast, start)
+                self.snapshots[body['seq']] = states
+                for i in [i for i in self.snapshots if i < body['seq'] - 64]:
+                    self.snapshots.pop(i)
+                if body['seq'] > self.last_snapshot:
+                    self.last_snapshot = body['seq']
+                    self.send({'request': ACK, 'data': {'seq': body['seq']}})
+        finally:
+            self.handle_lock.release()
+
+
+    def stay(self):
+        return
+
+    def walk(self):
+        self.x += self.direction * WALK_SPEED * PING_TIME
+        if abs(self.x - self.home) > WALK_RANGE:
+            self.direction = -self.direction
+
+    def target(self):  # клетка над головой: поставить и сломать можно всегда
+        return int(self.x), int(self.y) - 2
+
+    def place(self):
+        x, y = self.target()
+        self.stats.remember(self.stats.edits, (x, y))
+        self.send({'request': PLACE_BLOCK, 'data': {'x': x, 'y': y}})
+
+    def mine(self):
+        x, y = self.target()
+        self.stats.remember(self.stats.edits, (x, y))
+        self.send({'request': DESTROY_BLOCK, 'data': {'x': x, 'y': y}})
+
+    def ping(self):
+        self.stats.remember(self.stats.moves, (self.id, round(self.x * POSITION_SCALE), round(self.y * POSITION_SCALE)))
+        data = {'request': PING, 'data': {'x': self.x, 'y': self.y, 'dir': 2 if self.direction > 0 else 3,
+                                          'moving': self.direction != 0, 'selected': DIRT_SLOT,
+                                          'vx': self.direction * WALK_SPEED if 'walk' in self.script else 0, 'vy': 0}}
+        if self.datagram_socket is not None:
+            self.send_datagram(data)
+        if self.datagram_socket is None or not self.datagram_received:  # пока udp не ответил, дублируем по tcp
+            self.send(data)
+
+    def run(self):
+        step = 0
+        next_step = time.time()
+        try:
+            while self.running:
+                self.ping()  # сначала пинг: сервер должен знать выбранный слот до установки блока
+                getattr(self, self.script[step % len(self.script)])()
+                if step % ECHO_EVERY == 0:
+                    self.send({'request': ECHO, 'data': {'id': self.id, 'time': time.time()}})
+                step += 1
+                next_step += PING_TIME
+                time.sleep(max(0, next_step - time.time()))
+        except Exception:
+            if self.running:
+                self.stats.count(errors=1)
+        self.stop()
+
+    def stop(self):
+        if self.socket is None:
+            return
+        self.running = False
+        try:
+            self.send({'request': LEAVE_REQUEST, 'data': {}})
+            self.socket.close()
+            if self.datagram_socket is not None:
+                self.datagram_socket.close()
+        except Exception:
+            pass
+
+
+def start_bots(args, stats, bots, count):
+    for i in range(count):
+        bot = Bot('bot' + str(len(bots)), args.host, args.port, args.script, stats, args.codec, args.udp, args.world)
+        try:
+            bot.connect()
+        except Exception as e:
+            print('connect failed:', e)
+            stats.count(errors=1)
+            continue
+        bots.append(bot)
+        threading.Thread(target=bot.run, daemon=True).start()
+
+
+def report(stats, bots, interval, server=None):
+    res = stats.take()
+    line = 'bots %4d | sent %7.1f/s received %8.1f/s | rtt p50 %6.1f p99 %6.1f ms | broadcast p50 %6.1f p99 %6.1f ms | errors %d' % (
+        len([i for i in bots if i.running]), res['sent'] / interval, res['received'] / interval,
+        percentile(res['rtt'], 50) * 1000, percentile(res['rtt'], 99) * 1000,
+        percentile(res['broadcast'], 50) * 1000, percentile(res['broadcast'], 99) * 1000, res['errors'])
+    measured = server.take() if server is not None else None
+    if measured is not None:
+        line += ' | server %8.1f msg/s handler mean %6.2f p99 <= %6.1f ms' % (
+            measured['messages'], measured['handler_mean'] * 1000, measured['handler_p99'] * 1000)
+    print(line)
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='нагрузочный клиент: N ботов ходят, пингуют, копают и строят')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4400)
+    parser.add_argument('--bots', type=int, default=10, help='ботов сразу')
+    parser.add_argument('--script', default='mine', choices=sorted(SCRIPTS))
+    parser.add_argument('--codec', default=BINARY_CODEC, choices=CODECS)
+    parser.add_argument('--world', default='', help='мир на сервере с супервизором, пусто - мир по умолчанию')
+    parser.add_argument('--udp', action='store_true', help='пинги и снимки с одним движением по udp')
+    parser.add_argument('--duration', type=float, default=30, help='секунд без наращивания')
+    parser.add_argument('--interval', type=float, default=5, help='секунд между отчетами')
+    parser.add_argument('--ramp', type=int, default=0, help='добавлять столько ботов каждый отчет, пока сервер не захлебнется')
+    parser.add_argument('--max-bots', type=int, default=1000)
+    parser.add_argument('--limit', type=float, default=100, help='p99 задержки в мс, после которой сервер считается перегруженным')
+    parser.add_argument('--metrics-port', type=int, default=int(os.environ.get("METRICS_PORT", 0)),
+                        help='порт /metrics сервера: к отчету добавятся сообщения в секунду и время обработчиков на сервере')
+    args = parser.parse_args()
+
+    server = ServerMetrics(args.host, args.metrics_port) if args.metrics_port else None
+    if server is not None:
+        server.take()  # первое снятие - начало отсчета
+    stats = Stats()
+    bots = []
+    start_bots(args, stats, bots, args.bots)
+    started = time.time()
+    try:
+        while True:
+            time.sleep(args.interval)
+            res = report(stats, bots, args.interval, server)
+            if args.ramp:
+                worst = max(percentile(res['rtt'], 99), percentile(res['broadcast'], 99)) * 1000
+                if worst > args.limit or res['errors']:
+                    print('saturation at', len(bots), 'bots')
+                    break
+                if len(bots) >= args.max_bots:
+                    print('no saturation up to', len(bots), 'bots')
+                    break
+                start_bots(args, stats, bots, args.ramp)
+            elif time.time() - started >= args.duration:
+                break
+    except KeyboardInterrupt:
+        pass
+    for i in bots:
+        i.stop()
+
+
+if __name__ == '__main__':
+    main()
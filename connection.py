@@ -0,0 +1,434 @@
+import asyncio
+import json
+import select
+import socket
+import struct
+import threading
+from collections import deque
+from socket import IPPROTO_TCP, TCP_NODELAY, SHUT_RDWR
+from protocol import JSON_CODEC, RELAY_MARK, MAX_FRAME
+
+HEADER_SIZE = 16  # длина пакета передается 16 байтами перед ним
+READ_BUFFER_SIZE = 1 << 16
+OUTBOUND_LIMIT = 1024  # пакетов в очереди клиента, больше - клиент отключается
+OUTBOUND_BYTES = 8 << 20  # байт в очереди клиента, больше - клиент отключается
+OUTBOUND_SOFT_BYTES = 1 << 20  # байт в очереди, после которых движение клиенту не ставится - он и так отстал
+
+HIGH_PRIORITY = 0  # изменения мира, входы и выходы игроков
+LOW_PRIORITY = 1  # движение
+
+DATAGRAM_HEAD = struct.Struct('<QI')  # токен сессии и номер датаграммы, по номеру отбрасываются устаревшие
+MAX_DATAGRAM = 1200  # больше - по tcp, чтобы датаграмма не дробилась в пути
+
+RELAY_HEAD = struct.Struct('<BBH')  # метка, приоритет и число номеров сессий, за ними номера по 4 байта
+
+
+class QueuedConnection:  # исходящие пакеты клиента копятся в очереди и отправляются отдельным писателем
+    def __init__(self, limit=OUTBOUND_LIMIT, byte_limit=OUTBOUND_BYTES, soft_limit=OUTBOUND_SOFT_BYTES):
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.bytes_in = 0  # считает тот, кто читает соединение
+        self.bytes_out = 0
+        self.limit = limit
+        self.byte_limit = byte_limit
+        self.soft_limit = soft_limit
+        self.queued = 0  # байт в очередях
+        self.dropped = 0  # пакетов движения, не поставленных из-за отставания
+        self.evicted = None  # причина отключения медленного клиента
+        self.relay = False  # ретранслятор назвал секрет, его конверты принимаются
+        self.queues = (deque(), deque(maxlen=limit))  # у пингов важен только последний, старые вытесняются
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, prep, priority=HIGH_PRIORITY):  # никогда не блокируется на сети
+        overflow = False
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            if priority == LOW_PRIORITY and self.queued + len(prep) > self.soft_limit:
+                self.dropped += 1  # снимок придет следующим шагом разностью с подтвержденной базой
+                return
+            if priority == HIGH_PRIORITY and len(self.queues[HIGH_PRIORITY]) >= self.limit:
+                overflow = True
+                self.evicted = 'queue'
+            elif priority == HIGH_PRIORITY and self.queued + len(prep) > self.byte_limit:
+                overflow = True
+                self.evicted = 'bytes'
+            else:
+                was_empty = not (self.queues[0] or self.queues[1])
+                queue = self.queues[priority]
+                if queue.maxlen is not None and len(queue) == queue.maxlen:
+                    self.queued -= len(queue[0])  # вытесняется самый старый
+                queue.append(prep)
+                self.queued += len(prep)
+                if was_empty:
+                    self.wake()
+        finally:
+            self.lock.release()
+        if overflow:  # клиент не успевает читать
+            self.close()
+
+    def take(self):  # все накопленное одним буфером, сначала важные пакеты, вызывается под self.lock
+        batch = []
+        for queue in self.queues:
+            for prep in queue:
+                batch.append(len(prep).to_bytes(HEADER_SIZE, 'big'))
+                batch.append(prep)
+            queue.clear()
+        self.queued = 0
+        res = b''.join(batch)
+        self.bytes_out += len(res)
+        return res
+
+    def wake(self):
+        return
+
+
+class SocketConnection(QueuedConnection):  # клиент, обслуживаемый потоками чтения и записи
+    def __init__(self, socket, limit=OUTBOUND_LIMIT):
+        super().__init__(limit)
+        self.socket = socket
+        self.socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.ready = threading.Condition(self.lock)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def wake(self):
+        self.ready.notify()
+
+    def write_loop(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while not self.closed and not (self.queues[0] or self.queues[1]):
+                    self.ready.wait()
+                if self.closed:
+                    return
+                data = self.take()
+            finally:
+                self.lock.release()
+            try:
+                self.socket.sendall(data)  # заголовки и пакеты уходят одним вызовом
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self.ready.notify()
+        finally:
+            self.lock.release()
+        try:
+            self.socket.shutdown(SHUT_RDWR)  # будит поток чтения
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class StreamConnection(QueuedConnection):  # клиент в asyncio режиме, создается в потоке цикла событий
+    def __init__(self, writer, loop, limit=OUTBOUND_LIMIT):
+        super().__init__(limit)
+        self.writer = writer
+        self.loop = loop
+        self.writer.get_extra_info('socket').setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.ready = asyncio.Event()
+        self.task = loop.create_task(self.write_loop())
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                self.lock.acquire()
+                try:
+                    if self.closed:
+                        break
+                    data = self.take()
+                finally:
+                    self.lock.release()
+                if data:
+                    self.writer.write(data)
+                    await self.writer.drain()  # медленный клиент ждет только сам
+        except (OSError, asyncio.CancelledError):
+            pass
+        self.closed = True
+        self.writer.close()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+        finally:
+            self.lock.release()
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+
+class ClientConnection(QueuedConnection):  # соединение игрока с сервером: сокет пишет и читает только сетевой поток
+    def __init__(self, address, limit=OUTBOUND_LIMIT):
+        super().__init__(limit)
+        self.address = address
+        self.socket = None  # появится в open, до него пакеты копятся в очереди
+        self.reader = None
+        self.waker, self.wakeup = socket.socketpair()  # будит select, когда в пустой очереди появился пакет
+        self.waker.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.out = memoryview(b'')  # недописанный остаток буфера
+        self.finishing = False
+
+    def wake(self):
+        try:
+            self.wakeup.send(b'\0')
+        except OSError:  # буфер полон - select и так проснется
+            pass
+
+    def open(self, timeout):  # в сетевом потоке
+        sock = socket.create_connection(self.address, timeout)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self.lock.acquire()
+        try:
+            if not self.closed:
+                self.socket = sock
+                self.reader = FrameReader(sock)
+        finally:
+            self.lock.release()
+        if self.socket is not sock:  # закрыли, пока шло соединение
+            sock.close()
+            raise ConnectionError('connection closed')
+
+    def poll(self, timeout=None):  # дописывает очередь, сколько пустит сокет, и возвращает пришедшие пакеты
+        self.lock.acquire()
+        try:
+            if not self.closed and not self.out:
+                self.out = memoryview(self.take())
+            done = self.closed or (self.finishing and not self.out)
+        finally:
+            self.lock.release()
+        if done:
+            self.close()
+            raise ConnectionError('connection closed')
+        readable, writable, _ = select.select([self.socket, self.waker], [self.socket] if self.out else [], [], timeout)
+        if self.waker in readable:
+            try:
+                self.waker.recv(READ_BUFFER_SIZE)
+            except BlockingIOError:
+                pass
+        if writable:
+            try:
+                self.out = self.out[self.socket.send(self.out):]
+            except BlockingIOError:
+                pass
+        if self.socket not in readable:
+            return []
+        try:
+            return [bytes(i) for i in self.reader.frames()]  # пакет из буфера живет только до следующего чтения
+        except BlockingIOError:
+            return []
+
+    def finish(self):  # закрыть, когда очередь уйдет на сервер
+        self.lock.acquire()
+        try:
+            self.finishing = True
+            self.wake()
+        finally:
+            self.lock.release()
+        if self.socket is None:
+            self.close()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+        finally:
+            self.lock.release()
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        self.waker.close()
+        self.wakeup.close()
+
+
+class DatagramChannel:  # движение по udp, пока адрес клиента неизвестен или пакет не влезает - по tcp
+    def __init__(self, connection, token, transport):
+        self.connection = connection
+        self.codec = connection.codec
+        self.compression = connection.compression
+        self.token = token
+        self.transport = transport  # сокет или asyncio транспорт, у обоих есть sendto
+        self.address = None  # узнается из первой датаграммы клиента
+        self.received = 0  # последний принятый номер от клиента
+        self.sent = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def accept(self, seq, address, size):  # False - датаграмма обогнана более новой
+        if seq <= self.received:
+            return False
+        self.received = seq
+        self.address = address  # клиент мог сменить адрес, отвечаем туда, откуда пришло последнее
+        self.bytes_in += size
+        return True
+
+    def send(self, prep, priority=LOW_PRIORITY):
+        if self.address is None or DATAGRAM_HEAD.size + len(prep) > MAX_DATAGRAM:
+            self.connection.send(prep, priority)
+            return
+        self.sent += 1
+        data = pack_datagram(self.token, self.sent, prep)
+        try:
+            self.transport.sendto(data, self.address)
+            self.bytes_out += len(data)
+        except OSError:
+            pass  # потерянная датаграмма заменится следующей
+
+
+class RelayedConnection:  # клиент за ретранслятором: его пакеты идут в конвертах по общему соединению
+    def __init__(self, relay, id):
+        self.relay = relay
+        self.id = id  # номер сессии у ретранслятора
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.queued = 0  # очередь общая, у самого ретранслятора
+        self.dropped = 0
+        self.evicted = None
+        self.closed = False
+
+    def send(self, prep, priority=HIGH_PRIORITY):  # рассылка в flush собирает получателей в один конверт сама
+        if self.closed:
+            return
+        self.bytes_out += len(prep)
+        self.relay.send(pack_relay([self.id], prep, priority), priority)
+
+    def close(self):  # пустой конверт - ретранслятор отключит клиента
+        if self.closed:
+            return
+        self.relay.send(pack_relay([self.id], b''), HIGH_PRIORITY)
+        self.closed = True
+
+
+def pack_relay(ids, prep, priority=HIGH_PRIORITY):
+    return RELAY_HEAD.pack(RELAY_MARK, priority, len(ids)) + struct.pack('<%dI' % len(ids), *ids) + prep
+
+
+def unpack_relay(frame):  # (номера сессий, приоритет, вложенный пакет), пустой пакет - сессия закрыта
+    mark, priority, count = RELAY_HEAD.unpack_from(frame)
+    if not count:
+        raise ValueError('relay envelope without sessions')
+    ids = struct.unpack_from('<%dI' % count, frame, RELAY_HEAD.size)
+    return ids, priority, memoryview(frame)[RELAY_HEAD.size + 4 * count:]
+
+
+def pack_datagram(token, seq, prep):
+    return DATAGRAM_HEAD.pack(token, seq) + prep
+
+
+def unpack_datagram(data):  # (токен, номер, пакет) или None, если датаграмма слишком короткая
+    if len(data) <= DATAGRAM_HEAD.size:
+        return None
+    token, seq = DATAGRAM_HEAD.unpack_from(data)
+    return token, seq, memoryview(data)[DATAGRAM_HEAD.size:]
+
+
+class FrameReader:  # буферизованное чтение пакетов: один recv_into может принести сразу несколько пакетов
+    def __init__(self, socket, size=READ_BUFFER_SIZE):
+        self.socket = socket
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # границы еще не разобранных данных
+        self.end = 0
+
+    def reserve(self, total):  # освобождает место под пакет длины total
+        if total > len(self.buffer):  # старый буфер остается жить, пока на него ссылаются выданные пакеты
+            buffer = bytearray(max(total, len(self.buffer) * 2))
+            buffer[:self.end - self.start] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start + total > len(self.buffer):
+            self.view[:self.end - self.start] = self.view[self.start:self.end]
+        else:
+            return
+        self.end -= self.start
+        self.start = 0
+
+    def fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size:  # после большого пакета возвращаемся к обычному размеру
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+        elif self.end == len(self.buffer):
+            self.reserve(self.end - self.start + 1)
+        ln = self.socket.recv_into(self.view[self.end:])
+        if not ln:
+            raise ConnectionError('connection closed')
+        self.end += ln
+
+    def feed(self, data):  # байты этого соединения, прочитанные кем-то другим (супервизором)
+        self.reserve(self.end - self.start + len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def pending(self):  # еще не разобранные байты
+        return bytes(self.view[self.start:self.end])
+
+    def has_frame(self):
+        if self.end - self.start < HEADER_SIZE:
+            return False
+        return self.end - self.start >= HEADER_SIZE + int.from_bytes(self.view[self.start:self.start + HEADER_SIZE], 'big')
+
+    def next_frame(self):  # готовый пакет из буфера или None, пакет действителен до следующего обращения к буферу
+        if self.end - self.start < HEADER_SIZE:
+            return None
+        total = HEADER_SIZE + int.from_bytes(self.view[self.start:self.start + HEADER_SIZE], 'big')
+        if total > HEADER_SIZE + MAX_FRAME:  # не выделяем память под заявленную длину
+            raise ConnectionError('frame of ' + str(total - HEADER_SIZE) + ' bytes')
+        if self.end - self.start < total:
+            self.reserve(total)
+            return None
+        frame = self.view[self.start + HEADER_SIZE:self.start + total]
+        self.start += total
+        return frame
+
+    def frames(self):  # один системный вызов и все пакеты, пришедшие целиком; без вызова, если пакет уже есть
+        if not self.has_frame():
+            self.fill()
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def read(self):  # блокирующее чтение одного пакета
+        frame = self.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.next_frame()
+        return frame
+
+
+def send_socket(channel, client_socket, address, initial=b''):  # передает сокет клиента другому процессу
+    message = json.dumps({'address': list(address), 'initial': initial.hex()}).encode()
+    socket.send_fds(channel, [message], [client_socket.fileno()])
+
+
+def receive_socket(channel):  # (сокет, адрес, уже прочитанные из него байты)
+    message, fds, flags, address = socket.recv_fds(channel, READ_BUFFER_SIZE, 1)
+    if not fds:
+        raise ConnectionError('channel closed')
+    data = json.loads(message)
+    return socket.socket(fileno=fds[0]), tuple(data['address']), bytes.fromhex(data['initial'])
@@ -10,6 +10,7 @@ SETTINGS = 3
 MENU = 4
 CONNECT = 5
 CONNECT_ERROR = 6
+JOINING = 7
 
 GRAV_CONST = (2 * 9.8) / fps ** 2
 
@@ -27,7 +28,28 @@ JOIN = 9
 LEAVE = 10
 SYNC_BLOCK = 11
 SYNC_INVENTORY = 12
+SNAPSHOT = 13
+ACK = 14
+REGION_REQUEST = 15
+REGION = 16
+ECHO = 17
+HANDOFF = 18
+RESUME = 19  # ответ на вход с токеном сессии, клиент разбирает его в основном потоке
+EDIT_ACK = 20  # ответ на изменение блока с номером: принято или отменено
+CHECKSUM = 21  # сверка хэшей загруженных полос с сервером
+DISCONNECT = 22  # соединение потеряно, только внутри клиента: сетевой поток сообщает основному
+RELAY_AUTH = 23  # первый пакет ретранслятора: секрет, без него конверты не принимаются
 
-PING_TIME = 0.1
+PING_TIME = 0.1  # не чаще этого клиент шлет пинг, пока расходится с предсказанием
+PING_KEEPALIVE = 1.0  # стоящий игрок все равно шлет пинг раз в столько секунд
+PREDICTION_ERROR = 0.25  # блоков: на сколько позиция может разойтись с экстраполяцией без пинга
+MAX_EXTRAPOLATION = 1.25  # секунд: дольше чужого игрока по скорости не двигаем, чуть больше PING_KEEPALIVE
+INTERPOLATION_DELAY = 0.1  # секунд: чужие игроки показываются с таким отставанием от времени сервера
+INTERPOLATION_SAMPLES = 32  # отсчетов положения чужого игрока в памяти
+RESUME_ATTEMPTS = 5  # попыток вернуться в сессию после обрыва соединения
+RESUME_DELAY = 1  # секунд между ними
+CONNECT_TIMEOUT = 20  # секунд на соединение с сервером и ответ на вход
+CHECKSUM_TIME = 5  # секунд между сверками полос с сервером
+REGION_SIZE = 16  # изменения мира хранятся и передаются полосами по столько столбцов
 
 dirs = [(0, -1), (0, 1), (1, 0), (-1, 0)]
@@ -217,7 +217,7 @@ class GameInterface:
                 self.settings.handle_event(event)
             elif self.status == CONNECT:
                 self.connecting.handle_event(event)
-            elif self.status == CONNECT_ERROR:
+            elif self.status in [CONNECT_ERROR, JOINING]:  # во время входа кнопка отменяет его
                 self.server_message.handle_event(event)
 
     def draw(self):
@@ -233,7 +233,7 @@ class GameInterface:
                 self.settings.draw()
             elif self.status == CONNECT:
                 self.connecting.draw()
-            elif self.status == CONNECT_ERROR:
+            elif self.status in [CONNECT_ERROR, JOINING]:
                 self.server_message.draw(coff=1)
 
     def connect(self):
@@ -384,6 +384,25 @@ class Inventory:
             return self.main_container.add(item)
         return True
 
+    def remove_item(self, type, count):  # забирает count предметов type, откуда найдутся; False - столько не было
+        was = self.get_selected()
+        while count > 0:
+            pos = self.find_item(type)
+            if pos is None:
+                break
+            item = self.get(*pos)
+            taken = min(count, item.count)
+            item.count -= taken
+            count -= taken
+            if item.count <= 0:
+                if pos[1] == self.y_scale:
+                    self.bar_container.delete(pos[0], 0)
+                else:
+                    self.main_container.delete(*pos)
+        if self.get_selected() is not was:
+            self.check_selection(was)
+        return count == 0
+
     def check_selection(self, was):
         if was is not None:
             was.on_deselect(self.game)
@@ -10,7 +10,9 @@ from inventory import Inventory, Item
 from graphics import TileImage
 import json
 import os
+import hashlib
 from structures import BlockDrop
+from constants import REGION_SIZE
 import json
 
 
@@ -42,14 +44,38 @@ class ChunkController:
         self.min_height = min_height
         self.max_height = max_height
         self.changes = changes if changes is not None else {}
+        self.hashes = {}  # полоса -> xor хэшей измененных клеток, считается при первом обращении
+
+    def cell_hash(self, x, y, block):  # одинаков у клиента и сервера, в отличие от hash()
+        return int.from_bytes(hashlib.blake2b(('%d,%d,%s' % (x, y, block.type)).encode(), digest_size=8).digest(), 'big')
+
+    def region_hash(self, region):
+        if region not in self.hashes:
+            res = 0
+            for i in range(region * REGION_SIZE, (region + 1) * REGION_SIZE):
+                for g, block in list(self.changes.get(i, {}).items()):
+                    res ^= self.cell_hash(i, g, block)
+            self.hashes[region] = res
+        return self.hashes[region]
+
+    def regions_hash(self, regions):  # корень: совпал - совпадают и все полосы, иначе сравниваются полосы по одной
+        res = 0
+        for i in regions:
+            res ^= self.region_hash(i)
+        return res
 
     def get_player_start_pos(self, x):
         return self.max_ground - int(self.generator.noise1d(x) * self.max_ground) - 2
 
+    def set_change(self, x, y, block):  # все записи в changes идут сюда, иначе хэш полосы устареет
+        region = self.get_region(x)
+        if region in self.hashes:  # старая клетка уходит из хэша полосы, новая входит
+            was = self.changes.get(x, {}).get(y)
+            self.hashes[region] ^= self.cell_hash(x, y, block) ^ (self.cell_hash(x, y, was) if was is not None else 0)
+        self.changes.setdefault(x, {})[y] = block  # одна операция: полосы меняются из разных потоков
+
     def place_block(self, x, y, block, game):
-        if x not in self.changes:
-            self.changes[x] = {}
-        self.changes[x][y] = block
+        self.set_change(x, y, block)
         if not game.is_server:
             lx, ly = x - game.pos_center[0] + (game.block_width + game.additional) // 2, y - game.pos_center[1] + (game.block_height + game.additional) // 2
             if 0 <= lx < (game.block_width + game.additional) and 0 <= ly < (game.block_height + game.additional):
@@ -58,11 +84,7 @@ class ChunkController:
                 block.x = lx
                 block.y = ly
                 game.update_changes(was, block)
-                if not block.transparent:
-                    game.light_controller.max_y[lx] = min(game.light_controller.max_y[lx], y)
-                elif not was.transparent:
-                    game.light_controller.calc_max_y_for_x(lx, game.pos_center, self, game.objects)
-                game.light_controller.calculate_light(self.chunk, self.ground_height)
+                game.light_changed(lx, block)
         block.on_place(game)
 
     def generate_trees(self, x, y):
@@ -175,6 +197,24 @@ class ChunkController:
                 changes[i][g] = self.changes[i][g].save()
         return {'seed': self.seed, 'changes': changes}
 
+    def get_region(self, x):
+        return x // REGION_SIZE
+
+    def save_region(self, region):  # изменения в столбцах одной полосы
+        changes = {}
+        for i in range(region * REGION_SIZE, (region + 1) * REGION_SIZE):
+            if i in self.changes:
+                changes[i] = {g: self.changes[i][g].save() for g in self.changes[i]}
+        return changes
+
+    def load_region(self, changes, blocks):  # дополняет, а не заменяет - свои неподтвержденные изменения остаются
+        self.load({'seed': self.seed, 'changes': changes}, blocks)
+
+    def drop_region(self, region):
+        for i in range(region * REGION_SIZE, (region + 1) * REGION_SIZE):
+            self.changes.pop(i, None)
+        self.hashes.pop(region, None)
+
     def load_block(self, data, blocks):
         return blocks[data['type']].generate_block(**data)
 
@@ -182,7 +222,8 @@ class ChunkController:
         self.seed = data['seed']
         changes = data['changes']
         for i in changes.keys():
-            self.changes[int(i)] = {}
+            self.changes.setdefault(int(i), {})
+            self.hashes.pop(self.get_region(int(i)), None)  # посчитается заново
             for g in changes[i].keys():
                 changes[i][g]['x'] = 0
                 changes[i][g]['y'] = 0
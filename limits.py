@@ -0,0 +1,34 @@
+import time
+from constants import *
+
+# запрос -> (в среднем в секунду, подряд): больше от одного игрока не обрабатывается
+RATE_LIMITS = {
+    PLACE_BLOCK: (20, 40),
+    DESTROY_BLOCK: (20, 40),
+    BLOCK_UPDATE: (20, 40),
+    SYNC_BLOCK: (20, 40),
+    SYNC_INVENTORY: (20, 40),
+    CHECKSUM: (1, 2),  # сверка берет блокировки всех полос клиента
+    REGION_REQUEST: (5, 20),  # каждая полоса - снимок под ее блокировкой и сегмент копии
+}
+
+
+class TokenBucket:  # токены копятся со скоростью rate, но не больше burst, каждый запрос тратит один
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def take(self):  # вызывается под блокировкой владельца
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def make_buckets():
+    return {request: TokenBucket(rate, burst) for request, (rate, burst) in RATE_LIMITS.items()}
@@ -0,0 +1,74 @@
+import threading
+import time
+
+# Порядок захвата блокировок на сервере (иначе возможна взаимная блокировка):
+#   1. registry_lock - списки игроков и адресов, индекс игроков, кто кого видит
+#   2. RegionLocks.table_lock - только вместе с acquire_all при сохранении мира
+#   3. блокировки полос мира из RegionLocks, строго по возрастанию номера полосы
+#   4. ClientInstance.lock - состояние и инвентарь одного игрока, не больше одного за раз
+# broadcast_lock берется только в flush, когда ни одна из этих блокировок не удерживается.
+
+
+class CountingLock:  # блокировка, которая считает, сколько раз за нее пришлось ждать
+    def __init__(self, name=''):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+        self.waited = 0  # секунд ожидания всего
+
+    def acquire(self):
+        if self.lock.acquire(blocking=False):
+            self.acquired += 1
+            return True
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired += 1  # счетчики меняются только под самой блокировкой
+        self.contended += 1
+        self.waited += time.perf_counter() - start
+        return True
+
+    def release(self):
+        self.lock.release()
+
+
+class RegionLocks:  # блокировки полос мира, создаются при первом обращении к полосе
+    def __init__(self):
+        self.table_lock = threading.Lock()
+        self.locks = {}
+
+    def get(self, regions):
+        self.table_lock.acquire()
+        try:
+            return [self.locks.setdefault(i, CountingLock('region ' + str(i))) for i in sorted(set(regions))]
+        finally:
+            self.table_lock.release()
+
+    def acquire(self, regions):  # захватывает по возрастанию номера, возвращает то, что нужно отпустить
+        locks = self.get(regions)
+        for i in locks:
+            i.acquire()
+        return locks
+
+    def release(self, locks):
+        for i in reversed(locks):
+            i.release()
+
+    def acquire_all(self):  # весь мир сразу, новые полосы тем временем не появляются
+        self.table_lock.acquire()
+        locks = [self.locks[i] for i in sorted(self.locks)]
+        for i in locks:
+            i.acquire()
+        return locks
+
+    def release_all(self, locks):
+        self.release(locks)
+        self.table_lock.release()
+
+    def stats(self):  # (захватов, ожиданий, секунд ожидания) по всем полосам
+        self.table_lock.acquire()
+        try:
+            return (sum(i.acquired for i in self.locks.values()), sum(i.contended for i in self.locks.values()),
+                    sum(i.waited for i in self.locks.values()))
+        finally:
+            self.table_lock.release()
@@ -5,13 +5,15 @@ from noise import Noise, TwoDisNoise
 from constants import *
 import math
 import random
-from maths import check_square_collision, check_square_intersect
+from maths import check_square_collision, check_square_intersect, sample_path
 from structures import ObjectData, BlockDrop, GlobalRotatingObject, Block, Player, load_image, make_gl_image, createTexDL, gl_draw_single_tex
 from inventory import Inventory, Item
 from light_calculation import LightController
 from level_generation import ChunkController
 from game_interface import GameInterface
 from graphics import TileImage, draw_text
+from connection import ClientConnection, READ_BUFFER_SIZE, pack_datagram, unpack_datagram
+from protocol import encode, decode, CODECS, JSON_CODEC, COMPRESSION, FULL_STATE, HISTORY_SIZE, apply_delta, restore_state
 import threading
 import select
 import json
@@ -50,7 +52,10 @@ class Game:
 
         self.player = None
         self.other_players = {}
-        self.lerp_query = {}
+        self.player_id = None
+        self.lerp_query = {}  # id -> отсчеты положения (время сервера, x, y, vx, vy)
+        self.interpolation_delay = float(os.environ.get("INTERPOLATION_DELAY", INTERPOLATION_DELAY))
+        self.server_offset = None  # местное время минус время сервера, вместе с задержкой сети
         self.data_stack = deque()
         self.stack_lock = threading.Lock()
         self.sun = None
@@ -62,10 +67,32 @@ class Game:
         self.last_target = None
         self.interface = None
         self.running = False
-        self.socket = None
+        self.connection = None  # очередь пакетов серверу, сокетом владеет сетевой поток
         self.is_server = False
-        self.connected = False
-        self.data_handler = None
+        self.connected = False  # вход завершен
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.snapshots = {}  # шаг сервера -> {id: состояние}, базы для разностей
+        self.last_snapshot = -1
+        self.acked = -1
+        self.regions = set()  # полосы мира, запрошенные у сервера
+        self.regions_loaded = False  # пришла полоса - мир нужно перерисовать
+        self.light_dirty = False  # блоки менялись, свет пересчитается в конце кадра
+        self.dirty_columns = set()  # столбцы окна, где мог открыться путь свету сверху
+        self.last_ping = None  # (x, y, vx, vy, время, направление, движение, слот) последнего пинга
+        self.last_position = None  # (x, y, время) на прошлом кадре - из них скорость игрока
+        self.velocity = (0, 0)
+        self.datagram_socket = None  # udp для пингов, если сервер его предложил
+        self.datagram_token = 0
+        self.datagram_sent = 0
+        self.datagram_received = 0  # последний принятый номер, более старые датаграммы отбрасываются
+        self.server_address = None  # (ip, порт, имя) - для возвращения в сессию после обрыва
+        self.resume_token = None
+        self.change_seq = 0  # номер последнего полученного изменения мира
+        self.loaded_regions = set()  # полосы, которые уже пришли от сервера
+        self.edit_seq = 0
+        self.pending_edits = {}  # номер -> {'pos', 'base' - блок по данным сервера, 'items' - предсказанные изменения инвентаря}
+        self.last_checksum = 0  # время последней сверки полос
 
         self.block_size = 0
         self.block_height = 0
@@ -174,64 +201,208 @@ class Game:
         self.gen_load(data)
 
     def server_leave(self):
-        if not self.connected:
+        if self.connection is None:
             return
-        self.connected = False
-        self.data_handler = None
-        try:
+        if self.connected:
             self.send({'request': LEAVE_REQUEST, 'data': {}})
-            self.socket.close()
-        except Exception:
-            pass
-        finally:
-            self.socket = None
+        self.connected = False
+        self.connection.finish()  # сетевой поток допишет выход и закроет сокет сам
+        self.connection = None
+        if self.datagram_socket is not None:
+            self.datagram_socket.close()
+        self.datagram_socket = None
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.snapshots = {}
+        self.last_snapshot = self.acked = -1
+        self.regions = set()
+        self.loaded_regions = set()
+        self.regions_loaded = False
+        self.resume_token = None
+        self.change_seq = 0
+        self.pending_edits = {}
+        self.last_ping = self.last_position = None
+        self.velocity = (0, 0)
+        self.datagram_sent = self.datagram_received = 0
         self.other_players = {}
         self.data_stack = deque()
         self.lerp_query = {}
+        self.server_offset = None
         self.status = MENU
 
-    def send(self, data):
-        prep = bytes(json.dumps(data), encoding='ascii')
-        self.socket.send(len(prep).to_bytes(16, 'big'))  # сначала отправляется длина пакета
-        self.socket.send(prep)  # сам пакет
+    def send(self, data):  # только ставит пакет в очередь, отправит сетевой поток
+        connection = self.connection
+        if connection is not None:
+            connection.send(encode(data, self.codec, self.compression))
 
-    def receive(self):
-        ln = int.from_bytes(self.socket.recv(16), 'big')
-        data = json.loads(self.socket.recv(ln))
-        return data
+    def push(self, data, connection):  # пакет основному потоку, если соединение еще то же
+        self.stack_lock.acquire()
+        try:
+            if connection is self.connection:
+                self.data_stack.append(data)
+        finally:
+            self.stack_lock.release()
 
-    def connect(self, ip, port, name):
+    def send_datagram(self, data):  # дойдет или нет - неважно, следующий пинг все равно новее
+        self.datagram_sent += 1
         try:
-            self.new_game()
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((ip, int(port)))
-            self.connected = True
-            self.send({'request': JOIN_REQUEST, 'data': {'name': name}})
-            response = self.receive()
+            self.datagram_socket.send(pack_datagram(self.datagram_token, self.datagram_sent, encode(data, self.codec, self.compression)))
+        except OSError:
+            pass
+
+    def update_regions(self):  # запрашивает полосы мира вокруг игрока и забывает дальние
+        half = (self.block_width + self.additional) // 2 + 1
+        start = self.chunk_controller.get_region(int(self.player.x) - half)
+        end = self.chunk_controller.get_region(int(self.player.x) + half)
+        load = set(range(start, end + 1)) - self.regions
+        unload = set(i for i in self.regions if not start - 1 <= i <= end + 1)  # с запасом, чтобы не дергать на границе
+        if not load and not unload:
+            return
+        for i in unload:
+            self.chunk_controller.drop_region(i)
+            self.loaded_regions.discard(i)
+        self.regions = (self.regions | load) - unload
+        self.send({'request': REGION_REQUEST, 'data': {'load': sorted(load), 'unload': sorted(unload)}})
+
+    def send_ping(self):  # пинг только когда другие клиенты ошибутся, двигая игрока по последней скорости
+        now = time.time()
+        if self.last_position is not None and now > self.last_position[2]:
+            dt = now - self.last_position[2]
+            self.velocity = ((self.player.x - self.last_position[0]) / dt, (self.player.y - self.last_position[1]) / dt)
+        self.last_position = (self.player.x, self.player.y, now)
+        state = (int(self.player.model.direction), self.player.moving, self.player.inventory.selected[0])
+        if self.last_ping is not None:
+            x, y, vx, vy, sent = self.last_ping[:5]
+            delta = now - sent
+            error = max(abs(x + vx * delta - self.player.x), abs(y + vy * delta - self.player.y))
+            if state == self.last_ping[5:] and delta < PING_KEEPALIVE and (error <= PREDICTION_ERROR or delta < PING_TIME):
+                return
+        data = {'request': PING, 'data': {'x': self.player.x, 'y': self.player.y, 'dir': state[0], 'moving': state[1],
+                                          'selected': state[2], 'vx': self.velocity[0], 'vy': self.velocity[1]}}
+        if self.datagram_socket is not None:
+            self.send_datagram(data)
+        # по tcp, пока udp не заработал в обе стороны, и смена слота - сервер должен знать его до установки блока
+        if self.datagram_socket is None or not self.datagram_received or self.last_ping is None or state != self.last_ping[5:]:
+            self.send(data)
+        self.last_ping = (self.player.x, self.player.y) + self.velocity + (now,) + state
+
+    def connect(self, ip, port, name):  # не ждет сети: вход идет в сетевом потоке, ответ придет в data_stack
+        if self.connection is not None:
+            return
+        self.new_game()
+        self.server_address = (ip, port, name)
+        self.connection = ClientConnection((ip, int(port)))
+        self.interface.server_message.generate_text('Подключение к ' + ip + ':' + str(port), self.text_font, self.width // 20)
+        self.interface.status = JOINING
+        threading.Thread(target=self.network_loop, args=(self.connection, self.join_data(name)), daemon=True).start()
+
+    def joined(self, response):  # ответ на вход, в основном потоке
+        self.connected = True
+        self.interface.status = MENU
+        self.codec = response.get('codec', JSON_CODEC)  # дальше общаемся выбранным сервером кодеком
+        self.player_id = response.get('id')
+        self.compression = response.get('compression')
+        self.resume_token = response.get('resume')
+        self.change_seq = response.get('change', 0)
+        self.chunk_controller = ChunkController(self.block_width + self.additional,
+                                                self.block_height + self.additional,
+                                                response['seed'])  # изменения мира придут полосами
+        self.player.x = response['player_data']['x']
+        self.player.y = response['player_data']['y']
+        self.player.inventory.get_sync(response['player_data']['inventory'], self.objects)
+        self.started_time = time.time() - response['started_time']
+        for i in response['players']:
+            self.other_players[i['id']] = {'name': i['name'], 'model': Player(i['x'], i['y'], None, self), 'selected': self.objects[i['selected']].generate_item(1) if i['selected'] != 'None' else None}
+            self.other_players[i['id']]['model'].make_model()
+            self.other_players[i['id']]['model'].update_model(self.player.x, self.player.y)
+        self.open_datagram(response.get('udp'))
+        self.start()
+
+    def join_data(self, name):
+        return {'name': name, 'codecs': CODECS, 'compression': [COMPRESSION], 'udp': True, 'world': os.environ.get("WORLD", ''),
+                'view': [self.block_width + self.additional, self.block_height + self.additional]}
+
+    def open_datagram(self, udp):
+        if self.datagram_socket is not None:
+            self.datagram_socket.close()
+            self.datagram_socket = None
+        self.datagram_sent = self.datagram_received = 0
+        if udp:
+            self.datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.datagram_socket.connect((self.server_address[0], udp['port']))  # чужие датаграммы не примутся
+            self.datagram_socket.settimeout(1)
+            self.datagram_token = udp['token']
+            threading.Thread(target=self.datagram_receive, args=(self.datagram_socket, self.connection), daemon=True).start()
+
+    def enter(self, connection, join):  # в сетевом потоке: соединение и вход, (ответ, пакеты, пришедшие следом)
+        deadline = time.time() + CONNECT_TIMEOUT
+        connection.open(CONNECT_TIMEOUT)
+        connection.send(encode({'request': JOIN_REQUEST, 'data': join}))
+        frames = []
+        while not frames:
+            if time.time() > deadline:
+                raise TimeoutError('[server connection error]: join timed out')
+            frames = connection.poll(deadline - time.time())
+        return decode(frames[0]), frames[1:]
+
+    def network_loop(self, connection, join):  # сетевой поток: только он пишет в сокет и читает из него
+        try:
+            response, frames = self.enter(connection, join)
             if not response['success']:  # запрос наверное может быть отклонен
-                self.server_leave()
-                self.interface.server_message.generate_text(response['reason'], self.text_font, self.width // 20)
-                self.interface.status = CONNECT_ERROR
+                raise ConnectionError(response['reason'])
+        except Exception as e:
+            connection.close()
+            self.push({'request': DISCONNECT, 'data': {'reason': str(e)}}, connection)
+            return
+        self.push({'request': JOIN_REQUEST, 'data': response}, connection)
+        while True:
+            try:
+                while True:
+                    for frame in frames:
+                        self.push(decode(frame), connection)
+                    frames = connection.poll()
+            except Exception as e:
+                error = e
+            connection.close()
+            if connection is not self.connection:  # игрок вышел сам
                 return
-            self.chunk_controller = ChunkController(self.block_width + self.additional,
-                                                    self.block_height + self.additional,
-                                                    response['level']['chunk_controller']['seed'])
-            self.chunk_controller.load(response['level']['chunk_controller'], self.objects)  # загрузка соответствующего мира
-            self.player.x = response['player_data']['x']
-            self.player.y = response['player_data']['y']
-            self.player.inventory.get_sync(response['player_data']['inventory'], self.objects)
-            self.started_time = time.time() - response['started_time']
-            for i in response['players']:
-                self.other_players[i['id']] = {'name': i['name'], 'model': Player(i['x'], i['y'], None, self), 'selected': self.objects[i['selected']].generate_item(1) if i['selected'] != 'None' else None}
-                self.other_players[i['id']]['model'].make_model()
-                self.other_players[i['id']]['model'].update_model(self.player.x, self.player.y)
-            self.data_handler = threading.Thread(target=self.data_receive)
-            self.data_handler.start()
-            self.start()
-        except socket.error as e:
-            self.server_leave()
-            self.interface.server_message.generate_text(str(e), self.text_font, self.width // 20)
-            self.interface.status = CONNECT_ERROR
+            res = self.resume(connection)
+            if res is None:
+                self.push({'request': DISCONNECT, 'data': {'reason': str(error)}}, connection)
+                return
+            connection, frames = res  # дальше читаем новое соединение
+
+    def resume(self, old):  # вход заново с токеном сессии: сервер дошлет изменения уже загруженных полос
+        if self.resume_token is None:
+            return None
+        name = self.server_address[2]
+        for i in range(RESUME_ATTEMPTS):
+            time.sleep(RESUME_DELAY)
+            if old is not self.connection:
+                return None
+            connection = ClientConnection(old.address)
+            join = self.join_data(name)
+            join['resume'] = {'token': self.resume_token, 'change': self.change_seq,
+                              'regions': sorted(self.loaded_regions.copy())}
+            try:
+                response, frames = self.enter(connection, join)
+            except Exception:
+                connection.close()
+                continue
+            if not response['success']:
+                connection.close()
+                return None
+            self.stack_lock.acquire()
+            try:
+                if old is not self.connection:
+                    connection.close()
+                    return None
+                self.connection = connection  # пакеты, не ушедшие по старому соединению, пропали вместе с ним
+                self.data_stack.append({'request': RESUME, 'data': response})
+            finally:
+                self.stack_lock.release()
+            return connection, frames
+        return None
 
     def new_game(self):
         inventory = Inventory(9, 3, self.crafts, self)
@@ -275,9 +446,22 @@ class Game:
             self.phys_blocks_group.add(block)
         self.all_blocks.remove(was)
         self.all_blocks.add(block)
-        if block.worldpos[0] not in self.chunk_controller.changes:
-            self.chunk_controller.changes[block.worldpos[0]] = {}
-        self.chunk_controller.changes[block.worldpos[0]][block.worldpos[1]] = block
+
+    def light_changed(self, x, block):  # вместо пересчета света на каждый блок - один пересчет за кадр
+        if not block.transparent:
+            self.light_controller.max_y[x] = min(self.light_controller.max_y[x], block.worldpos[1])
+        else:
+            self.dirty_columns.add(x)
+        self.light_dirty = True
+
+    def update_light(self):
+        if not self.light_dirty:
+            return
+        for x in self.dirty_columns:
+            self.light_controller.calc_max_y_for_x(x, self.pos_center, self.chunk_controller, self.objects)
+        self.dirty_columns.clear()
+        self.light_dirty = False
+        self.light_controller.calculate_light(self.chunk_controller.chunk, self.chunk_controller.ground_height)
 
     def place_block(self, x, y, player):
         block = self.chunk_controller.chunk[y][x]
@@ -289,16 +473,13 @@ class Game:
             return
         new = self.objects[player.inventory.get_selected().type].generate_block(x, y, block.worldpos)
         self.update_changes(block, new)
+        self.chunk_controller.set_change(block.worldpos[0], block.worldpos[1], new)
         self.chunk_controller.chunk[y][x] = new
         self.chunk_controller.chunk[y][x].on_place(self)
         player.inventory.place_selected()
-        if not new.transparent:
-            self.light_controller.max_y[x] = min(self.light_controller.max_y[x], new.worldpos[1])
-        elif not block.transparent:
-            self.light_controller.calc_max_y_for_x(new.x, self.pos_center, self.chunk_controller, self.objects)
-        self.light_controller.calculate_light(self.chunk_controller.chunk, self.chunk_controller.ground_height)
+        self.light_changed(x, new)
         if self.connected:
-            self.send({'request': PLACE_BLOCK, 'data': {'x': new.worldpos[0], 'y': new.worldpos[1]}})
+            self.predict_edit(PLACE_BLOCK, block, [(new.type, -1)])
 
     def draw_single_light(self, block):  # рисует свет на блоке
         if not block.transparent:
@@ -324,15 +505,58 @@ class Game:
         block.on_destroy(self)
         new = self.objects['empty'].generate_block(x, y, block.worldpos)
         self.update_changes(block, new)
+        self.chunk_controller.set_change(block.worldpos[0], block.worldpos[1], new)
         self.last_target = None
+        items = []
         if block.drop is not None:
             drop = block.drop.get_drop()
             player.inventory.add_item(self.objects[drop[0]].generate_item(drop[1]))
+            items.append(drop)
         self.chunk_controller.chunk[y][x] = new
-        self.light_controller.calc_max_y_for_x(new.x, self.pos_center, self.chunk_controller, self.objects)
-        self.light_controller.calculate_light(self.chunk_controller.chunk, self.chunk_controller.ground_height)
+        self.light_changed(x, new)
         if self.connected:
-            self.send({'request': DESTROY_BLOCK, 'data': {'x': new.worldpos[0], 'y': new.worldpos[1]}})
+            self.predict_edit(DESTROY_BLOCK, block, items)
+
+    def predict_edit(self, request, block, items):  # изменение уже показано, сервер по номеру подтвердит или отменит его
+        self.edit_seq += 1
+        base = block.copy()
+        base.hp = self.objects[block.type].hp  # сломанный блок при отмене возвращается целым
+        self.pending_edits[self.edit_seq] = {'pos': tuple(block.worldpos), 'base': base, 'items': items}
+        self.send({'request': request, 'data': {'x': block.worldpos[0], 'y': block.worldpos[1], 'seq': self.edit_seq}})
+
+    def pending_at(self, pos):  # неподтвержденные изменения клетки по порядку
+        return [i for i in self.pending_edits.values() if i['pos'] == pos]
+
+    def pending_regions(self):  # в этих полосах мир у клиента и сервера может законно расходиться
+        return set(self.chunk_controller.get_region(i['pos'][0]) for i in self.pending_edits.values())
+
+    def send_checksum(self):  # корень хэшей загруженных полос, сервер ответит, только если он разошелся
+        self.last_checksum = time.time()
+        regions = sorted(self.loaded_regions - self.pending_regions())
+        if regions:
+            self.send({'request': CHECKSUM, 'data': {'change': self.change_seq, 'regions': regions,
+                                                     'root': self.chunk_controller.regions_hash(regions)}})
+
+    def reconcile_edit(self, body):
+        edit = self.pending_edits.pop(body['seq'], None)
+        if edit is None:
+            return
+        block = self.chunk_controller.load_block(body['block'], self.objects) if body['ok'] else edit['base']
+        later = self.pending_at(edit['pos'])
+        if later:  # следующее предсказание в этой клетке показано поверх ответа сервера
+            later[0]['base'] = block
+        else:
+            self.chunk_controller.place_block(edit['pos'][0], edit['pos'][1], block, self)
+        counts = {}  # на сколько предсказанный инвентарь разошелся с сервером
+        for kind, count in body['items']:
+            counts[kind] = counts.get(kind, 0) + count
+        for kind, count in edit['items']:
+            counts[kind] = counts.get(kind, 0) - count
+        for kind, count in counts.items():
+            if count > 0:
+                self.player.inventory.add_item(self.objects[kind].generate_item(count))
+            elif count < 0:
+                self.player.inventory.remove_item(kind, -count)
 
     def damage_block(self, x, y, dmg, player):
         block = self.chunk_controller.chunk[y][x]
@@ -363,6 +587,8 @@ class Game:
                          self.player.y)
         self.light_controller.calc_max_y(self.pos_center, self.chunk_controller, self.objects)
         self.light_controller.calculate_light(self.chunk_controller.chunk, self.chunk_controller.ground_height)
+        self.dirty_columns.clear()  # весь свет уже пересчитан
+        self.light_dirty = False
 
     def draw_blocks_in_screen(self, draw_order):
         startx, starty = GAME.get_view_start()  # определяет область от общей области, которая видна игроку
@@ -465,33 +691,31 @@ class Game:
         self.player.draw()
         self.draw_all_light()
 
-    def data_receive(self):  # получает данные с сервера в отдельном потоке (чтобы основной не ложить)
-        try:
-            while True:
-                data = self.receive()
-                if not data or not self.connected:
-                    return
-                self.stack_lock.acquire()
-                try:
-                    self.data_stack.append(data)
-                finally:
-                    self.stack_lock.release()
-        except socket.error as e:
-            self.interface.server_message.generate_text(str(e), self.text_font, self.width // 20)
-            self.server_leave()
-            self.interface.status = CONNECT_ERROR
-            return
-        except Exception:
-            pass  # жсоны выбивает если сокет умирает
+    def datagram_receive(self, datagram_socket, connection):  # снимки с одним движением, которые сервер отправил по udp
+        while self.connected and datagram_socket is self.datagram_socket:
+            try:
+                res = unpack_datagram(datagram_socket.recv(READ_BUFFER_SIZE))
+            except socket.timeout:  # проверить, не отключились ли
+                continue
+            except OSError:
+                return
+            if res is None or res[0] != self.datagram_token or res[1] <= self.datagram_received:
+                continue  # чужая или обогнанная более новой
+            self.datagram_received = res[1]
+            data = decode(res[2])
+            data['datagram'] = True  # номер изменений мира из нее не берется - tcp с изменениями мог еще не дойти
+            self.push(data, connection)
 
     def data_handle(self, data):  # обрабатывает данные с сервера
         body = data['data']
         if data['request'] == PING:
+            if body['id'] not in self.other_players:  # пинг мог обогнать вход игрока или прийти после выхода
+                return
             model = self.other_players[body['id']]['model']
-            self.lerp_query[body['id']] = (model.x, model.y, body['x'], body['y'], time.time())
-            model.x = body['x']
-            model.y = body['y']
-            model.update_model(self.player.x, self.player.y)
+            samples = self.lerp_query.setdefault(body['id'], deque(maxlen=INTERPOLATION_SAMPLES))
+            if samples and body['time'] <= samples[-1][0]:
+                samples.pop()  # снимок того же шага пришел повторно
+            samples.append((body['time'], body['x'], body['y'], body['vx'], body['vy']))  # покажется позже, в run
             model.model.direction = body['dir']
             model.moving = body['moving']
             self.other_players[body['id']]['selected'] = self.objects[body['selected']].generate_item(1) if body['selected'] != 'None' else None
@@ -504,12 +728,114 @@ class Game:
             self.other_players[body['id']]['model'].update_model(self.player.x, self.player.y)
         elif data['request'] == BLOCK_UPDATE:
             new = self.chunk_controller.load_block(body['block'], self.objects)
-            self.chunk_controller.place_block(body['x'], body['y'], new, self)
+            pending = self.pending_at((body['x'], body['y']))
+            if pending:  # сервер применил это раньше нашего изменения - показывать рано, ответ на наше все решит
+                pending[0]['base'] = new
+            else:
+                self.chunk_controller.place_block(body['x'], body['y'], new, self)
+        elif data['request'] == EDIT_ACK:
+            self.reconcile_edit(body)
+        elif data['request'] == CHECKSUM:  # разошедшиеся полосы забываются, update_regions запросит их заново
+            if body['change'] != self.change_seq:
+                return  # пока шел ответ, пришли новые изменения
+            pending = self.pending_regions()
+            for region, value in body['hashes']:
+                if region in self.loaded_regions and region not in pending and self.chunk_controller.region_hash(region) != value:
+                    self.chunk_controller.drop_region(region)
+                    self.regions.discard(region)
+                    self.loaded_regions.discard(region)
         elif data['request'] == LEAVE:
-            self.other_players.pop(body['id'])
-            self.lerp_query.pop(body['id'])
+            self.other_players.pop(body['id'], None)
+            self.lerp_query.pop(body['id'], None)
+            for i in self.snapshots.values():  # при возвращении сервер пришлет полное состояние
+                i.pop(body['id'], None)
+        elif data['request'] == REGION:
+            if body['region'] in self.regions:  # полоса могла быть забыта, пока шел ответ
+                self.chunk_controller.load_region(body['changes'], self.objects)
+                self.loaded_regions.add(body['region'])
+                self.regions_loaded = True
+        elif data['request'] == HANDOFF:  # роутер перевел игрока на сервер соседней полосы, там своя нумерация шагов
+            self.player_id = body['id']
+            self.snapshots = {}
+            self.last_snapshot = self.acked = -1
+            self.server_offset = None  # у другого сервера свои часы
+            self.last_ping = None  # новый сервер должен узнать слот и направление
+            self.other_players = {}
+            self.lerp_query = {}
+            for i in self.regions:  # изменения этих полос теперь знает новый сервер
+                self.chunk_controller.drop_region(i)
+            self.regions = set()
+            self.loaded_regions = set()
+            self.resume_token = body.get('resume')
+            self.change_seq = body.get('change', 0)
+            self.pending_edits = {}  # полосы загрузятся заново, EDIT_ACK от старого сервера уже не придет
+            self.player.x = body['player_data']['x']  # состояние, с которым нас принял новый сервер
+            self.player.y = body['player_data']['y']
+            self.player.inventory.get_sync(body['player_data']['inventory'], self.objects)
+            for i in body['players']:
+                self.data_handle({'request': JOIN, 'data': i})
+        elif data['request'] == JOIN_REQUEST:
+            self.joined(body)
+        elif data['request'] == DISCONNECT:  # сетевой поток не смог войти или вернуться в сессию
+            self.server_leave()
+            self.interface.server_message.generate_text(body['reason'], self.text_font, self.width // 20)
+            self.interface.status = CONNECT_ERROR
+        elif data['request'] == RESUME:  # вернулись в сессию по новому соединению, у него своя нумерация шагов
+            for seq in sorted(self.pending_edits, reverse=True):  # изменение могло не дойти до сервера - откатываем
+                edit = self.pending_edits[seq]
+                self.chunk_controller.place_block(edit['pos'][0], edit['pos'][1], edit['base'], self)
+            self.pending_edits = {}  # дошедшие до сервера изменения придут из журнала, инвентарь - с ответом
+            self.player_id = body['id']
+            self.codec = body.get('codec', JSON_CODEC)  # новое соединение договорилось о кодеке заново
+            self.compression = body.get('compression')
+            self.snapshots = {}
+            self.last_snapshot = self.acked = -1
+            self.last_ping = None
+            self.other_players = {}
+            self.lerp_query = {}
+            resumed = set(body['regions'])
+            for i in self.regions - resumed:  # журнал сервера не помнит пропущенного - эти полосы загрузятся заново
+                self.chunk_controller.drop_region(i)
+            self.regions = set(resumed)
+            self.loaded_regions = set(resumed)
+            self.resume_token = body['resume']
+            self.change_seq = body['change']
+            self.player.inventory.get_sync(body['player_data']['inventory'], self.objects)
+            for i in body['replay']:
+                self.data_handle(i)
+            for i in body['players']:
+                self.data_handle({'request': JOIN, 'data': i})
+            self.open_datagram(body.get('udp'))
+            self.regions_loaded = True
         elif data['request'] == SYNC_BLOCK:
             self.chunk_controller.get(body['x'], body['y'], self.objects, self).get_sync(body['block'])
+        elif data['request'] == SNAPSHOT:  # все изменения за шаг сервера
+            for source, message in body['blocks']:
+                if source is None or source != self.player_id:  # свои изменения уже применены
+                    self.data_handle(message)
+            if not data.get('datagram'):  # снимок без изменений блоков может обогнать более новый - номер только растет
+                self.change_seq = max(self.change_seq, body['change'])
+            if body['base'] != -1 and body['base'] not in self.snapshots:
+                return  # базы уже нет, сервер пришлет разности от подтвержденного шага
+            states = dict(self.snapshots.get(body['base'], {}))
+            for i in body['players']:
+                if i['mask'] & FULL_STATE or i['id'] in states:
+                    states[i['id']] = apply_delta(states.get(i['id']), i)
+            self.snapshots[body['seq']] = states
+            for i in [i for i in self.snapshots if i <= body['seq'] - HISTORY_SIZE]:
+                self.snapshots.pop(i)
+            if body['seq'] > self.last_snapshot:  # устаревший шаг, обогнанный более новым, не показываем
+                self.last_snapshot = body['seq']
+                offset = time.time() - body['time']
+                if self.server_offset is None or offset < self.server_offset:  # самый быстрый снимок точнее всего
+                    self.server_offset = offset
+                else:  # медленно отпускаем, если часы разошлись
+                    self.server_offset += (offset - self.server_offset) * 0.01
+                for i in body['players']:
+                    if i['id'] in states and i['id'] != self.player_id:
+                        state = restore_state(i['id'], states[i['id']])
+                        state['time'] = body['time']
+                        self.data_handle({'request': PING, 'data': state})
 
     def run(self):
         pygame.init()
@@ -520,13 +846,13 @@ class Game:
         self.status = MENU
         self.initialise()
         self.started_time = time.time()
-        last_send = time.time()
         while self.running:
             try:
                 if self.connected:
-                    if time.time() - last_send > PING_TIME:  # пинг на сервер
-                        self.send({'request': PING, 'data': {'x': self.player.x, 'y': self.player.y, 'dir': self.player.model.direction, 'moving': self.player.moving, 'selected': self.player.inventory.selected[0]}})
-                        last_send = time.time()
+                    self.update_regions()
+                    self.send_ping()
+                    if time.time() - self.last_checksum > CHECKSUM_TIME:
+                        self.send_checksum()
                 self.stack_lock.acquire()
                 try:  # обрабатываю полученные данные с сервера
                     while len(self.data_stack):
@@ -534,14 +860,18 @@ class Game:
                         self.data_handle(data)
                 finally:
                     self.stack_lock.release()
-                for i in self.lerp_query.items():  # интерполирую координаты других игроков
-                    delta = time.time() - i[1][-1]
-                    x1, y1 = i[1][0], i[1][1]
-                    x2, y2 = i[1][2], i[1][3]
-                    #self.other_players[i[0]]['model'].x = x1 + (1 - math.cos(4 * delta * math.pi)) * (x2 - x1)
-                    #self.other_players[i[0]]['model'].y = y1 + (1 - math.cos(4 * delta * math.pi)) * (y2 - y1)
-                    self.other_players[i[0]]['model'].x = x1 + 10 * delta * (x2 - x1)
-                    self.other_players[i[0]]['model'].y = y1 + 10 * delta * (y2 - y1)
+                if self.regions_loaded:
+                    self.regions_loaded = False
+                    self.redraw_all()
+                self.update_light()  # все изменения блоков за кадр - один пересчет света
+                if self.connected and self.acked < self.last_snapshot:  # подтверждаем последний шаг один раз за кадр
+                    self.acked = self.last_snapshot
+                    self.send({'request': ACK, 'data': {'seq': self.acked}})
+                if self.server_offset is not None:  # другие игроки показываются с отставанием, между пришедшими положениями
+                    render_time = time.time() - self.server_offset - self.interpolation_delay
+                    for i in self.lerp_query.items():
+                        model = self.other_players[i[0]]['model']
+                        model.x, model.y = sample_path(i[1], render_time, MAX_EXTRAPOLATION)
                 glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
                 for event in pygame.event.get():
                     if event.type == pygame.QUIT:
@@ -2,6 +2,19 @@ def lerp(t, a, b):
     return a + t * (b - a)
 
 
+def sample_path(samples, t, limit):  # положение в момент t по отсчетам (время, x, y, vx, vy)
+    last = samples[-1]
+    if t >= last[0]:  # новее последнего отсчета - по его скорости, но не дальше limit секунд
+        ahead = min(t - last[0], limit)
+        return last[1] + last[3] * ahead, last[2] + last[4] * ahead
+    for i in range(len(samples) - 1, 0, -1):  # нужный отрезок обычно в конце
+        a, b = samples[i - 1], samples[i]
+        if a[0] <= t:
+            k = (t - a[0]) / (b[0] - a[0])
+            return lerp(k, a[1], b[1]), lerp(k, a[2], b[2])
+    return samples[0][1], samples[0][2]
+
+
 def area(a_x, a_y, b_x, b_y, c_x, c_y):
     return (b_x - a_x) * (c_y - a_y) - (b_y - a_y) * (c_x - a_x)
 
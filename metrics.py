@@ -0,0 +1,83 @@
+import threading
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+PREFIX = 'minecraft_'
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                          for k, v in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i in range(len(self.buckets)):
+            if value <= self.buckets[i]:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        res = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            res.append(name + '_bucket' + format_labels(labels, [('le', bound)]) + ' ' + str(total))
+        res.append(name + '_bucket' + format_labels(labels, [('le', '+Inf')]) + ' ' + str(self.count))
+        res.append(name + '_sum' + format_labels(labels) + ' ' + str(self.sum))
+        res.append(name + '_count' + format_labels(labels) + ' ' + str(self.count))
+        return res
+
+
+class Metrics:  # счетчики и гистограммы сервера в текстовом формате Prometheus
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> Histogram
+
+    def inc(self, name, labels=(), value=1):
+        self.lock.acquire()
+        try:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, labels=()):
+        self.lock.acquire()
+        try:
+            if (name, labels) not in self.histograms:
+                self.histograms[(name, labels)] = Histogram()
+            self.histograms[(name, labels)].observe(value)
+        finally:
+            self.lock.release()
+
+    def render(self, gauges=()):  # gauges - (имя, тип, метки, значение), снятые в момент запроса
+        metrics = {}  # имена получают общую приставку
+        self.lock.acquire()
+        try:
+            for (name, labels), value in self.counters.items():
+                metrics.setdefault((PREFIX + name, COUNTER), []).append(PREFIX + name + format_labels(labels) + ' ' + str(value))
+            for (name, labels), histogram in self.histograms.items():
+                metrics.setdefault((PREFIX + name, HISTOGRAM), []).extend(histogram.render(PREFIX + name, labels))
+        finally:
+            self.lock.release()
+        for name, kind, labels, value in gauges:
+            metrics.setdefault((PREFIX + name, kind), []).append(PREFIX + name + format_labels(labels) + ' ' + str(value))
+        res = []
+        for (name, kind), lines in sorted(metrics.items()):
+            res.append('# TYPE ' + name + ' ' + kind)
+            res.extend(lines)
+        return '\n'.join(res) + '\n'
@@ -0,0 +1,281 @@
+import json
+import os
+import struct
+import sys
+import zlib
+from constants import *
+
+if getattr(sys, 'frozen', False):
+    application_path = os.path.dirname(sys.executable)
+else:
+    application_path = os.path.dirname(os.path.abspath(__file__))
+
+JSON_CODEC = 'json'
+BINARY_CODEC = 'binary'
+CODECS = [BINARY_CODEC, JSON_CODEC]  # в порядке предпочтения
+
+BINARY_MARK = 0  # json всегда начинается с '{', а бинарное сообщение - с нулевого байта
+COMPRESSED_MARK = 1  # сжатое сообщение любого кодека
+RELAY_MARK = 2  # конверт ретранслятора: номера сессий за ним и вложенный пакет, см. connection.pack_relay
+COMPRESS_THRESHOLD = 256  # сообщения короче не сжимаются - пинги идут как есть
+MAX_FRAME = 4 << 20  # байт: больше не бывает даже у полосы мира, длиннее пакет не читается и не распаковывается
+MESSAGE_HEAD = struct.Struct('<BB')  # метка и код сообщения
+STRING_LEN = struct.Struct('<H')
+
+
+def make_dictionary():  # заготовка для zlib: частые ключи и имена всех блоков, самое частое - в конце
+    names = []
+    for i in sorted(os.listdir(os.path.join(application_path, 'objects'))):
+        if os.path.splitext(i)[1] == '.json':
+            names.append(json.load(open(os.path.join(application_path, 'objects', i), 'r'))['name'])
+    parts = ['"success": true, ', '"reason": ', '"players": [', '"player_data": ', '"inventory": ', '"x_size": ',
+             '"y_size": ', '"buffer": ', '"main": [[', '"craft": [[', '"bar": [[', '"additional": ', '"region": ',
+             '"changes": {', '{"request": ', '"data": {']
+    parts += ['{"type": "' + i + '", "count": ' for i in names]
+    parts += ['{"type": "' + i + '", "hp": ' for i in names]
+    parts += ['"transparent": ', '"lighting": ', '"is_phys": ', '"worldpos": [', '"drop": [', '"None", ']
+    return ''.join(parts).encode('ascii')
+
+
+ZDICT = make_dictionary()
+COMPRESSION = 'zlib-' + format(zlib.crc32(ZDICT), '08x')  # словарь должен совпадать у обеих сторон
+
+
+def pack_string(text):
+    data = text.encode('utf-8')
+    return STRING_LEN.pack(len(data)) + data
+
+
+def unpack_string(view, pos):
+    ln = STRING_LEN.unpack_from(view, pos)[0]
+    pos += STRING_LEN.size
+    return str(view[pos:pos + ln], 'utf-8'), pos + ln
+
+
+def flatten_block(body):  # блок раскладывается в плоский набор полей
+    block = body['block']
+    res = {'x': body['x'], 'y': body['y'], 'wx': block['worldpos'][0], 'wy': block['worldpos'][1]}
+    for i in block:
+        if i == 'drop':
+            res['drop_type'], res['drop_min'], res['drop_max'] = block['drop']
+        elif i != 'worldpos':
+            res[i] = block[i]
+    return res
+
+
+def restore_block(flat):
+    block = {'type': flat['type'], 'hp': flat['hp'], 'transparent': flat['transparent'], 'lighting': flat['lighting'],
+             'is_phys': flat['is_phys'], 'worldpos': [flat['wx'], flat['wy']]}
+    if 'drop_type' in flat:
+        block['drop'] = [flat['drop_type'], flat['drop_min'], flat['drop_max']]
+    return {'x': flat['x'], 'y': flat['y'], 'block': block}
+
+
+class BinaryMessage:  # сообщение с фиксированным набором полей: сначала числа одним struct, потом строки
+    def __init__(self, code, request, numbers, strings=(), flatten=None, restore=None):
+        self.code = code
+        self.request = request
+        self.numbers = [i[0] for i in numbers]
+        self.strings = list(strings)
+        self.keys = set(self.numbers) | set(self.strings)
+        self.struct = struct.Struct('<' + ''.join(i[1] for i in numbers))
+        self.flatten = flatten
+        self.restore = restore
+
+    def match(self, request, body):
+        return request == self.request and set(body) == self.keys
+
+    def pack_body(self, body):
+        res = [self.struct.pack(*[body[i] for i in self.numbers])]
+        for i in self.strings:
+            res.append(pack_string(body[i]))
+        return b''.join(res)
+
+    def unpack_body(self, view, pos):
+        body = dict(zip(self.numbers, self.struct.unpack_from(view, pos)))
+        pos += self.struct.size
+        for i in self.strings:
+            body[i], pos = unpack_string(view, pos)
+        return body, pos
+
+    def pack(self, body):
+        return MESSAGE_HEAD.pack(BINARY_MARK, self.code) + self.pack_body(body)
+
+    def unpack(self, view):
+        body = self.unpack_body(view, MESSAGE_HEAD.size)[0]
+        if self.restore is not None:
+            body = self.restore(body)
+        return {'request': self.request, 'data': body}
+
+
+POSITION_SCALE = 64  # координаты игроков передаются с точностью до 1/64 блока
+STATE_FIELDS = [('x', 'i'), ('y', 'i'), ('moving', '?'), ('dir', 'b'), ('selected', None), ('vx', 'i'), ('vy', 'i')]  # порядок битов маски
+DELTA_FIELDS = 2  # x и y передаются разницей с базой, остальное - новым значением
+FULL_STATE = 1 << len(STATE_FIELDS)  # бит маски: значения абсолютные, база не нужна
+HISTORY_SIZE = 64  # сколько последних шагов может служить базой
+
+
+def quantise_state(data):  # состояние игрока в целых числах, чтобы сравнение с базой было точным
+    return (round(data['x'] * POSITION_SCALE), round(data['y'] * POSITION_SCALE), bool(data['moving']),
+            int(data['dir']), data['selected'], round(data.get('vx', 0) * POSITION_SCALE),
+            round(data.get('vy', 0) * POSITION_SCALE))
+
+
+def restore_state(id, state):
+    return {'id': id, 'x': state[0] / POSITION_SCALE, 'y': state[1] / POSITION_SCALE, 'moving': state[2],
+            'dir': state[3], 'selected': state[4], 'vx': state[5] / POSITION_SCALE, 'vy': state[6] / POSITION_SCALE}
+
+
+def make_delta(id, old, new):  # только изменившиеся поля, None если игрок не изменился, old None - полное состояние
+    mask = FULL_STATE if old is None else 0
+    entry = {'id': id}
+    for ind, (name, fmt) in enumerate(STATE_FIELDS):
+        if old is None or old[ind] != new[ind]:
+            mask |= 1 << ind
+            entry[name] = new[ind] - old[ind] if old is not None and ind < DELTA_FIELDS else new[ind]
+    if not mask:
+        return None
+    entry['mask'] = mask
+    return entry
+
+
+def apply_delta(old, entry):
+    full = entry['mask'] & FULL_STATE
+    res = [None] * len(STATE_FIELDS) if full else list(old)
+    for ind, (name, fmt) in enumerate(STATE_FIELDS):
+        if entry['mask'] & (1 << ind):
+            res[ind] = res[ind] + entry[name] if not full and ind < DELTA_FIELDS else entry[name]
+    return tuple(res)
+
+
+class SnapshotMessage:  # пачка разностей состояний игроков и изменений блоков за один шаг сервера
+    def __init__(self, code):
+        self.code = code
+        self.request = SNAPSHOT
+        self.flatten = None
+        self.head = struct.Struct('<IidIHH')  # номер шага, база, время сервера, номер изменений мира, число игроков и изменений
+        self.entry = struct.Struct('<IB')  # id и маска полей
+        self.fields = [None if fmt is None else struct.Struct('<' + fmt) for name, fmt in STATE_FIELDS]
+        self.change = struct.Struct('<iI')
+
+    def match(self, request, body):
+        return request == self.request and set(body) == {'seq', 'base', 'time', 'change', 'players', 'blocks'}
+
+    def pack(self, body):
+        res = [MESSAGE_HEAD.pack(BINARY_MARK, self.code),
+               self.head.pack(body['seq'], body['base'], body['time'], body['change'], len(body['players']),
+                              len(body['blocks']))]
+        for i in body['players']:  # после маски идут только отмеченные в ней поля
+            res.append(self.entry.pack(i['id'], i['mask']))
+            for ind, (name, fmt) in enumerate(STATE_FIELDS):
+                if i['mask'] & (1 << ind):
+                    res.append(pack_string(i[name]) if fmt is None else self.fields[ind].pack(i[name]))
+        for source, message in body['blocks']:  # изменения блоков вкладываются целыми сообщениями
+            prep = encode(message, BINARY_CODEC)
+            res.append(self.change.pack(-1 if source is None else source, len(prep)))
+            res.append(prep)
+        return b''.join(res)
+
+    def unpack(self, view):
+        seq, base, stamp, change, players_count, blocks_count = self.head.unpack_from(view, MESSAGE_HEAD.size)
+        pos = MESSAGE_HEAD.size + self.head.size
+        body = {'seq': seq, 'base': base, 'time': stamp, 'change': change, 'players': [], 'blocks': []}
+        for i in range(players_count):
+            id, mask = self.entry.unpack_from(view, pos)
+            pos += self.entry.size
+            data = {'id': id, 'mask': mask}
+            for ind, (name, fmt) in enumerate(STATE_FIELDS):
+                if mask & (1 << ind):
+                    if fmt is None:
+                        data[name], pos = unpack_string(view, pos)
+                    else:
+                        data[name] = self.fields[ind].unpack_from(view, pos)[0]
+                        pos += self.fields[ind].size
+            body['players'].append(data)
+        for i in range(blocks_count):
+            source, ln = self.change.unpack_from(view, pos)
+            pos += self.change.size
+            body['blocks'].append([None if source == -1 else source, decode(view[pos:pos + ln], None)])
+            pos += ln
+        return {'request': self.request, 'data': body}
+
+
+BLOCK_FIELDS = [('x', 'q'), ('y', 'q'), ('hp', 'd'), ('transparent', 'B'), ('lighting', 'd'), ('is_phys', 'B'),
+                ('wx', 'q'), ('wy', 'q')]
+
+BINARY_MESSAGES = [
+    BinaryMessage(1, PING, [('x', 'd'), ('y', 'd'), ('dir', 'b'), ('moving', '?'), ('selected', 'B')]),  # от клиента
+    BinaryMessage(2, PING, [('id', 'I'), ('x', 'd'), ('y', 'd'), ('dir', 'b'), ('moving', '?')], ['selected']),  # от сервера
+    BinaryMessage(3, PLACE_BLOCK, [('x', 'q'), ('y', 'q')]),
+    BinaryMessage(4, DESTROY_BLOCK, [('x', 'q'), ('y', 'q')]),
+    BinaryMessage(5, BLOCK_UPDATE, BLOCK_FIELDS, ['type'], flatten_block, restore_block),
+    BinaryMessage(6, BLOCK_UPDATE, BLOCK_FIELDS + [('drop_min', 'H'), ('drop_max', 'H')], ['type', 'drop_type'],
+                  flatten_block, restore_block),
+    BinaryMessage(7, JOIN, [('id', 'I'), ('x', 'd'), ('y', 'd')], ['name', 'selected']),
+    BinaryMessage(8, LEAVE, [('id', 'I')]),
+    BinaryMessage(9, LEAVE_REQUEST, []),
+    SnapshotMessage(10),
+    BinaryMessage(11, ACK, [('seq', 'I')]),
+    BinaryMessage(12, ECHO, [('id', 'I'), ('time', 'd')]),  # в обе стороны
+    BinaryMessage(13, PING, [('x', 'd'), ('y', 'd'), ('dir', 'b'), ('moving', '?'), ('selected', 'B'), ('vx', 'f'),
+                             ('vy', 'f')]),  # от клиента со скоростью для экстраполяции
+    BinaryMessage(14, PLACE_BLOCK, [('x', 'q'), ('y', 'q'), ('seq', 'I')]),  # с номером - сервер ответит EDIT_ACK
+    BinaryMessage(15, DESTROY_BLOCK, [('x', 'q'), ('y', 'q'), ('seq', 'I')]),
+]
+BINARY_BY_CODE = {i.code: i for i in BINARY_MESSAGES}
+BINARY_BY_REQUEST = {}
+for message in BINARY_MESSAGES:
+    BINARY_BY_REQUEST.setdefault(message.request, []).append(message)
+
+
+def choose_codec(offered):  # сервер выбирает лучший кодек из предложенных клиентом
+    for i in CODECS:
+        if i in offered:
+            return i
+    return JSON_CODEC
+
+
+def choose_compression(offered):
+    return COMPRESSION if COMPRESSION in offered else None
+
+
+def compress(prep):
+    packer = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, zdict=ZDICT)
+    res = bytes([COMPRESSED_MARK]) + packer.compress(prep) + packer.flush()
+    return res if len(res) < len(prep) else prep
+
+
+def encode_binary(data):  # ответы на запросы не имеют поля request и всегда идут в json
+    for message in BINARY_BY_REQUEST.get(data.get('request'), []):
+        try:
+            flat = data['data'] if message.flatten is None else message.flatten(data['data'])
+            if message.match(data['request'], flat):
+                return message.pack(flat)
+        except (KeyError, TypeError, ValueError, struct.error):
+            continue  # не подходит под формат - пробуем следующий
+    return None
+
+
+def encode(data, codec=JSON_CODEC, compression=None):
+    prep = None
+    if codec == BINARY_CODEC:
+        prep = encode_binary(data)
+    if prep is None:
+        prep = bytes(json.dumps(data), encoding='ascii')
+    if compression == COMPRESSION and len(prep) >= COMPRESS_THRESHOLD:
+        return compress(prep)
+    return prep
+
+
+def decode(view, compression=COMPRESSION):  # формат определяется по первому байту, так что json понимается всегда
+    if view[0] == COMPRESSED_MARK:  # сжатое принимается только от тех, с кем о сжатии договорились
+        if compression != COMPRESSION:
+            raise ValueError('compression was not negotiated')
+        unpacker = zlib.decompressobj(zdict=ZDICT)
+        prep = unpacker.decompress(view[1:], MAX_FRAME)
+        if unpacker.unconsumed_tail:
+            raise ValueError('compressed message is larger than ' + str(MAX_FRAME) + ' bytes')
+        return decode(prep, None)
+    if view[0] == BINARY_MARK:
+        return BINARY_BY_CODE[view[1]].unpack(view)
+    return json.loads(bytes(view))
@@ -0,0 +1,221 @@
+import os
+import secrets
+import socket
+import threading
+import time
+from constants import *
+from connection import SocketConnection, FrameReader, HEADER_SIZE, HIGH_PRIORITY, pack_relay, unpack_relay
+from protocol import encode, decode, RELAY_MARK
+
+# Ретранслятор держит одно соединение с сервером и принимает много клиентов. Пакеты клиентов уходят серверу
+# в конвертах с номером сессии, сервер отвечает одним конвертом на всех получателей сообщения, а ретранслятор
+# сам копирует его каждому. Кому что нужно, решает сервер - в конверте только те, кому сообщение положено.
+# Снизу может подключиться другой ретранслятор: его конверты перекладываются в свои со своими номерами.
+# Конверты принимаются только от того, кто первым пакетом назвал общий секрет RELAY_SECRET.
+
+KEEPALIVE_TIME = 5  # секунд между эхо серверу, чтобы он не счел ретранслятор пропавшим
+RECONNECT_DELAY = 1  # секунд между попытками переподключиться к серверу
+
+
+class Downstream:  # соединение снизу: клиент или ретранслятор следующего уровня
+    def __init__(self, relay, client_socket):
+        self.relay = relay
+        self.connection = SocketConnection(client_socket)  # своя очередь и писатель - медленный клиент ждет только сам
+        self.reader = FrameReader(client_socket)
+        self.ids = {}  # номер сессии внизу (None - само соединение) -> номер у сервера
+        self.trusted = False  # снизу ретранслятор, назвавший секрет
+
+    def authenticate(self, frame):  # True - это был вход ретранслятора, серверу он не пересылается
+        if frame[0] != ord('{'):
+            return False
+        request = decode(frame, None)
+        if request.get('request') != RELAY_AUTH:
+            return False
+        self.trusted = secrets.compare_digest(self.relay.secret.encode(), str(request['data'].get('secret', '')).encode())
+        self.connection.send(encode({'request': RELAY_AUTH, 'data': {'success': self.trusted}}), HIGH_PRIORITY)
+        if not self.trusted:
+            self.connection.close()
+        return True
+
+    def run(self):
+        self.relay.ready.wait()  # пакеты клиента некуда отправить, пока нет сервера
+        first = True
+        try:
+            while self.relay.running and not self.connection.closed:
+                for frame in self.reader.frames():
+                    if first:
+                        first = False
+                        if self.authenticate(frame):
+                            continue
+                    if frame[0] == RELAY_MARK:
+                        if not self.trusted:
+                            raise ConnectionError('relay envelope before RELAY_AUTH')
+                        ids, priority, inner = unpack_relay(frame)
+                        self.forward(ids[0], inner)
+                    elif self.trusted:  # свои пакеты ретранслятор шлет только эхом, отвечаем сами
+                        self.connection.send(bytes(frame), HIGH_PRIORITY)
+                    else:
+                        self.forward(None, frame)
+        except Exception as e:
+            if self.relay.running and not self.connection.closed:
+                print(e)
+        finally:
+            for id in list(self.ids.values()):
+                self.relay.forget(id)
+                self.relay.send_up(pack_relay([id], b''))  # сервер выпустит игроков этого соединения
+            self.ids = {}
+            self.connection.close()
+
+    def forward(self, child, inner):
+        id = self.ids.get(child)
+        if id is None:
+            id = self.ids[child] = self.relay.register(self, child)
+        self.relay.send_up(pack_relay([id], bytes(inner)))
+        if not len(inner):  # ретранслятор снизу потерял своего клиента
+            self.ids.pop(child)
+            self.relay.forget(id)
+
+    def deliver(self, children, prep, priority):
+        if None in children:  # само соединение - клиент
+            if not prep:
+                self.connection.close()
+            else:
+                self.connection.send(prep, priority)
+            children = [i for i in children if i is not None]
+        if children:
+            self.connection.send(pack_relay(children, prep, priority), priority)
+            if not prep:
+                for i in children:
+                    self.ids.pop(i, None)
+
+
+class Relay:
+    def __init__(self, port, upstream, isLocal=True):
+        self.port = int(os.environ.get("PORT", port))
+        host, upstream_port = os.environ.get("UPSTREAM", upstream).rsplit(':', 1)
+        self.upstream_address = (host, int(upstream_port))  # сервер или ретранслятор уровнем выше
+        self.secret = os.environ.get("RELAY_SECRET", '')  # им ретранслятор входит наверх и проверяет ретрансляторы снизу
+        if not self.secret:
+            raise ValueError('RELAY_SECRET is required')
+        self.ip = '127.0.0.1' if isLocal else '0.0.0.0'
+        print(self.ip, self.port, '->', *self.upstream_address)
+        self.upstream = None
+        self.sessions = {}  # номер у сервера -> (Downstream, номер внизу)
+        self.sessions_lock = threading.Lock()
+        self.last_id = 0
+        self.ready = threading.Event()  # соединение с сервером есть
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((self.ip, self.port))
+        self.socket.listen(40)
+        self.running = True
+
+    def register(self, downstream, child):
+        self.sessions_lock.acquire()
+        try:
+            self.last_id += 1
+            self.sessions[self.last_id] = (downstream, child)
+            return self.last_id
+        finally:
+            self.sessions_lock.release()
+
+    def forget(self, id):
+        self.sessions_lock.acquire()
+        try:
+            self.sessions.pop(id, None)
+        finally:
+            self.sessions_lock.release()
+
+    def send_up(self, prep):
+        upstream = self.upstream
+        if upstream is not None:
+            upstream.send(prep, HIGH_PRIORITY)
+
+    def pump_down(self, reader):  # сервер -> клиенты, каждый конверт раскладывается по соединениям снизу
+        while self.running:
+            for frame in reader.frames():
+                if frame[0] != RELAY_MARK:
+                    continue  # ответ на эхо
+                ids, priority, inner = unpack_relay(frame)
+                prep = bytes(inner)
+                targets = {}  # Downstream -> номера внизу
+                self.sessions_lock.acquire()
+                try:
+                    for id in ids:
+                        if id in self.sessions:
+                            downstream, child = self.sessions[id]
+                            targets.setdefault(downstream, []).append(child)
+                            if not prep:  # сервер закрыл сессию
+                                self.sessions.pop(id)
+                finally:
+                    self.sessions_lock.release()
+                for downstream, children in targets.items():
+                    downstream.deliver(children, prep, priority)
+
+    def keepalive(self, upstream):
+        while self.running and not upstream.closed:
+            upstream.send(encode({'request': ECHO, 'data': {'id': 0, 'time': time.time()}}), HIGH_PRIORITY)
+            time.sleep(KEEPALIVE_TIME)
+
+    def authenticate(self, upstream_socket, reader):  # первый пакет наверх - секрет, без него конверты не примут
+        prep = encode({'request': RELAY_AUTH, 'data': {'secret': self.secret}})
+        upstream_socket.sendall(len(prep).to_bytes(HEADER_SIZE, 'big') + prep)
+        upstream_socket.settimeout(CONNECT_TIMEOUT)
+        try:
+            response = decode(reader.read(), None)
+        finally:
+            upstream_socket.settimeout(None)
+        if not response['data'].get('success'):
+            raise ConnectionError(response['data'].get('reason', 'relay rejected'))
+
+    def serve_upstream(self):  # при потере сервера клиенты отключаются и вернутся в сессии сами
+        while self.running:
+            upstream_socket = None
+            try:
+                upstream_socket = socket.create_connection(self.upstream_address)
+                reader = FrameReader(upstream_socket)
+                self.authenticate(upstream_socket, reader)
+            except (OSError, ValueError) as e:
+                print(e)
+                if upstream_socket is not None:
+                    upstream_socket.close()
+                time.sleep(RECONNECT_DELAY)
+                continue
+            self.upstream = SocketConnection(upstream_socket)
+            self.ready.set()
+            threading.Thread(target=self.keepalive, args=(self.upstream,), daemon=True).start()
+            try:
+                self.pump_down(reader)
+            except Exception as e:
+                if self.running:
+                    print(e)
+            self.ready.clear()
+            self.upstream.close()
+            self.upstream = None
+            self.sessions_lock.acquire()
+            try:
+                downstreams = set(i[0] for i in self.sessions.values())
+                self.sessions = {}
+            finally:
+                self.sessions_lock.release()
+            for i in downstreams:
+                i.connection.close()
+
+    def run(self):
+        threading.Thread(target=self.serve_upstream, daemon=True).start()
+        while self.running:
+            try:
+                client_sock, address = self.socket.accept()
+                threading.Thread(target=Downstream(self, client_sock).run, daemon=True).start()
+            except Exception:
+                pass
+
+    def exit(self):
+        self.running = False
+        self.socket.close()
+        if self.upstream is not None:
+            self.upstream.close()
+
+
+if __name__ == '__main__':
+    relay = Relay(4401, '127.0.0.1:4400', isLocal=False)
+    relay.run()
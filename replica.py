@@ -0,0 +1,198 @@
+import json
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+from constants import *
+from protocol import encode
+
+# Копия изменений мира по полосам в разделяемой памяти: основной процесс пишет, процессы-читатели отдают полосы
+# клиентам, не трогая блокировки сервера. Каждая полоса - свой сегмент с заголовком (версия, длина, поколение).
+# Данные полосы - журнал записей: первая - все изменения полосы, следующие - клетки, измененные за шаг сервера,
+# читатель накладывает их по порядку. Полный снимок пишется заново, только когда записей накопилось много.
+# Запись идет под seqlock: версия нечетна, пока данные меняются, читатель повторяет чтение, если версия
+# нечетна или изменилась за время чтения. Переросшая сегмент полоса переезжает в новый вдвое больший сегмент
+# следующего поколения. Нулевое поколение живет, пока жива полоса, и указывает читателю текущее, промежуточные
+# удаляются сразу: кто успел их открыть, дочитает по ссылке на следующее или начнет с нулевого. Полоса, на которую
+# никто не подписан, выбрасывается вместе с сегментами. Читатель открывает сегменты на время одного чтения.
+
+SEGMENT_HEAD = struct.Struct('<QII')  # версия, длина данных, поколение
+RECORD_HEAD = struct.Struct('<I')  # длина записи журнала
+SEGMENT_SIZE = 4096  # начальный размер сегмента полосы
+COMPACT_RECORDS = 256  # записей в журнале полосы, после которых она перепишется одним снимком
+READ_ATTEMPTS = 100  # попыток прочитать полосу, пока писатель ее меняет
+READ_BACKOFF = 0.0001  # секунд ожидания после неудачной попытки, удваивается
+READ_BACKOFF_MAX = 0.02
+EVICTED = 0xFFFFFFFF  # поколение в заголовке выброшенной полосы: такого сегмента нет
+
+
+def segment_name(prefix, region, generation):
+    return prefix + '_' + str(region) + '_' + str(generation)
+
+
+class Segment:
+    def __init__(self, memory, generation):
+        self.memory = memory
+        self.generation = generation
+        self.version = 0
+        self.length = 0  # байт журнала, знает только писатель
+
+    def head(self):
+        return SEGMENT_HEAD.unpack_from(self.memory.buf, 0)
+
+    def set_version(self, version):
+        struct.pack_into('<Q', self.memory.buf, 0, version)
+        self.version = version
+
+
+class RegionReplica:  # писатель, только в основном процессе и только под registry_lock
+    def __init__(self, prefix=None):
+        self.prefix = prefix or 'region_' + str(os.getpid())
+        self.segments = {}  # полоса -> [нулевое поколение, текущее], пока не было роста - одно нулевое
+        self.published = set()  # полосы, копия которых совпадает с миром
+        self.records = {}  # полоса -> записей в журнале
+
+    def version(self, region):  # четная версия последней записи, None - полоса еще не записана
+        if region not in self.segments:
+            return None
+        return self.segments[region][-1].version
+
+    def publish(self, region, payload):  # журнал заменяется полным снимком полосы
+        self.write(region, 0, RECORD_HEAD.pack(len(payload)) + payload)
+        self.records[region] = 1
+        self.published.add(region)
+
+    def append(self, region, payload):  # изменения клеток дописываются в конец журнала
+        self.write(region, self.segments[region][-1].length, RECORD_HEAD.pack(len(payload)) + payload)
+        self.records[region] += 1
+
+    def compacted(self, region):  # False - журнал длинный, полосу пора переписать снимком
+        return self.records.get(region, 0) <= COMPACT_RECORDS
+
+    def write(self, region, offset, data):
+        chain = self.segments.get(region)
+        if chain is None or SEGMENT_HEAD.size + offset + len(data) > chain[-1].memory.size:
+            chain = self.grow(region, offset + len(data))
+        segment = chain[-1]
+        segment.set_version(segment.version + 1)  # нечетная: читатели ждут
+        segment.length = offset + len(data)
+        SEGMENT_HEAD.pack_into(segment.memory.buf, 0, segment.version, segment.length, segment.generation)
+        segment.memory.buf[SEGMENT_HEAD.size + offset:SEGMENT_HEAD.size + segment.length] = data
+        segment.set_version(segment.version + 1)
+
+    def grow(self, region, size):  # журнал переезжает в сегмент побольше как есть
+        chain = self.segments.setdefault(region, [])
+        capacity = SEGMENT_SIZE
+        while capacity < SEGMENT_HEAD.size + size:
+            capacity *= 2
+        if chain:
+            capacity = max(capacity, chain[-1].memory.size * 2)
+        generation = chain[-1].generation + 1 if chain else 0
+        memory = shared_memory.SharedMemory(segment_name(self.prefix, region, generation), create=True, size=capacity)
+        segment = Segment(memory, generation)
+        if chain:
+            old = chain[-1]
+            memory.buf[SEGMENT_HEAD.size:SEGMENT_HEAD.size + old.length] = old.memory.buf[SEGMENT_HEAD.size:SEGMENT_HEAD.size + old.length]
+            segment.length = old.length
+            self.redirect(old, generation)  # читатель перейдет в новый сегмент
+            segment.version = old.version  # версия полосы растет дальше, а не начинается заново
+            if old is not chain[0]:  # промежуточное поколение больше не нужно, новые читатели начинают с нулевого
+                self.redirect(chain[0], generation)
+                chain.pop()
+                self.retire(old)
+        SEGMENT_HEAD.pack_into(memory.buf, 0, segment.version, segment.length, generation)
+        chain.append(segment)
+        return chain
+
+    def redirect(self, segment, generation):  # данных в сегменте больше нет, искать в этом поколении
+        segment.set_version(segment.version + 1)
+        SEGMENT_HEAD.pack_into(segment.memory.buf, 0, segment.version, 0, generation)
+        segment.set_version(segment.version + 1)
+
+    def retire(self, segment):  # открывшие сегмент читатели дочитают его, новые его уже не найдут
+        segment.memory.close()
+        segment.memory.unlink()
+
+    def evict(self, region):  # на полосу никто не подписан: сегменты удаляются, при запросе она запишется заново
+        for segment in self.segments.pop(region, []):
+            self.redirect(segment, EVICTED)
+            self.retire(segment)
+        self.published.discard(region)
+        self.records.pop(region, None)
+
+    def reset(self):  # мир загружен заново: полосы перезапишутся при следующем запросе
+        for region in list(self.segments):
+            self.evict(region)
+        self.published = set()
+        self.records = {}
+
+    def close(self):
+        self.reset()
+
+
+class ReplicaReader:  # читатель в процессе-помощнике
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def attach(self, region, generation):
+        try:
+            memory = shared_memory.SharedMemory(segment_name(self.prefix, region, generation))
+        except FileNotFoundError:
+            return None
+        return Segment(memory, generation)
+
+    def read(self, region):  # (версия, данные), None - полосы нет
+        segment = self.attach(region, 0)
+        try:
+            delay = READ_BACKOFF
+            for i in range(READ_ATTEMPTS):
+                if segment is None:
+                    return None
+                if i:  # писатель держит полосу недолго - ждем его, а не крутимся
+                    time.sleep(delay)
+                    delay = min(READ_BACKOFF_MAX, delay * 2)
+                version, length, generation = segment.head()
+                if version % 2:
+                    continue
+                if generation != segment.generation:  # полоса переехала или выброшена
+                    segment.memory.close()
+                    segment = None if generation == EVICTED else \
+                        self.attach(region, generation) or self.attach(region, 0)  # промежуточное уже удалено
+                    delay = READ_BACKOFF
+                    continue
+                payload = bytes(segment.memory.buf[SEGMENT_HEAD.size:SEGMENT_HEAD.size + length])
+                if segment.head()[0] == version:
+                    return version, payload
+            raise TimeoutError('region ' + str(region) + ' is being rewritten')
+        finally:
+            if segment is not None:
+                segment.memory.close()
+
+
+reader = None  # свой у каждого процесса-помощника
+
+
+def start_worker(prefix):
+    global reader
+    reader = ReplicaReader(prefix)
+
+
+def read_log(payload):  # журнал полосы в изменения по столбцам, поздние записи поверх ранних
+    changes = {}
+    pos = 0
+    while pos < len(payload):
+        ln = RECORD_HEAD.unpack_from(payload, pos)[0]
+        pos += RECORD_HEAD.size
+        for column, cells in json.loads(payload[pos:pos + ln]).items():
+            changes.setdefault(column, {}).update(cells)
+        pos += ln
+    return changes
+
+
+def region_frame(region, codec, compression):  # (полоса, версия, готовый пакет REGION для кодека клиента)
+    res = reader.read(region)
+    if res is None:
+        raise KeyError('region ' + str(region) + ' is not published')
+    version, payload = res
+    return region, version, encode({'request': REGION, 'data': {'region': region, 'changes': read_log(payload)}},
+                                   codec, compression)
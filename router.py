@@ -0,0 +1,187 @@
+import os
+import socket
+import threading
+from constants import *
+from connection import FrameReader, HEADER_SIZE
+from protocol import encode, decode, JSON_CODEC, BINARY_MARK
+from sharding import parse_shards, find_shard
+
+# Роутер принимает клиентов на одном адресе и передает пакеты серверу полосы, в которой стоит игрок.
+# Сервер, из полосы которого игрок ушел, присылает HANDOFF с его состоянием - роутер входит с ним на сервер
+# соседней полосы и переключает клиента туда. Клиенту приходит HANDOFF с ответом нового сервера на вход.
+
+SPAWN_X = 100000  # здесь появляются новые игроки, см. Server.handle_join
+
+
+def send_frame(sock, prep):
+    sock.sendall(len(prep).to_bytes(HEADER_SIZE, 'big') + bytes(prep))
+
+
+class Session:  # один клиент: соединение с ним и с сервером его полосы
+    def __init__(self, router, client_socket):
+        self.router = router
+        self.client = client_socket
+        self.client_reader = FrameReader(client_socket)
+        self.client_lock = threading.Lock()
+        self.upstream = None
+        self.upstream_reader = None
+        self.shard = None
+        self.lock = threading.Lock()  # отправка серверу и смена сервера
+        self.join = None  # запрос входа клиента, повторяется на новом сервере
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.running = True
+
+    def send_client(self, prep):
+        self.client_lock.acquire()
+        try:
+            send_frame(self.client, prep)
+        finally:
+            self.client_lock.release()
+
+    def enter(self, shard, handoff=None):  # вход на сервер полосы, возвращает (сокет, читатель, ответ)
+        join = dict(self.join)
+        if handoff is not None:
+            join['handoff'] = handoff
+            join['secret'] = self.router.secret
+        upstream = socket.create_connection(shard)
+        upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = FrameReader(upstream)
+        send_frame(upstream, encode({'request': JOIN_REQUEST, 'data': join}))
+        return upstream, reader, decode(reader.read())
+
+    def run(self):
+        try:
+            request = decode(self.client_reader.read(), None)  # до входа сжатие не согласовано
+            if request['request'] != JOIN_REQUEST:
+                return
+            self.join = dict(request['data'])
+            self.join.pop('handoff', None)
+            self.join['udp'] = False  # датаграммы через роутер не ходят
+            shard = self.router.locate(self.join['name'])
+            self.upstream, self.upstream_reader, response = self.enter(shard)
+            self.shard = shard
+            self.codec = response.get('codec', JSON_CODEC)
+            self.compression = response.get('compression')
+            self.send_client(encode(response, self.codec, self.compression))
+            if not response['success']:
+                return
+            threading.Thread(target=self.pump_down, daemon=True).start()
+            self.pump_up()
+        except Exception as e:
+            if self.running:
+                print(e)
+        finally:
+            self.close()
+
+    def pump_up(self):  # клиент -> сервер, пакеты не разбираются
+        while self.running:
+            for frame in self.client_reader.frames():
+                self.lock.acquire()
+                try:
+                    send_frame(self.upstream, frame)
+                finally:
+                    self.lock.release()
+
+    def pump_down(self):  # сервер -> клиент, разбираются только небинарные пакеты - среди них может быть HANDOFF
+        try:
+            while self.running:
+                for frame in self.upstream_reader.frames():
+                    if frame[0] != BINARY_MARK:
+                        data = decode(frame)
+                        if data.get('request') == HANDOFF:
+                            self.hand_off(data['data'])
+                            break  # дальше читаем уже новый сервер
+                    self.send_client(frame)
+        except Exception as e:
+            if self.running:
+                print(e)
+        self.close()
+
+    def hand_off(self, data):
+        shard = find_shard(self.router.shards, data['x'])
+        if shard is None:
+            raise ConnectionError('no shard owns x=' + str(data['x']))
+        upstream, reader, response = self.enter(shard, data['player'])
+        if not response['success']:
+            upstream.close()
+            raise ConnectionError(response['reason'])
+        self.lock.acquire()
+        try:
+            old = self.upstream
+            self.upstream, self.upstream_reader, self.shard = upstream, reader, shard
+        finally:
+            self.lock.release()
+        old.close()  # старый сервер уже забыл игрока
+        self.router.remember(data['name'], shard)
+        self.send_client(encode({'request': HANDOFF, 'data': response}, self.codec, self.compression))
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.lock.acquire()
+        try:
+            for i in [self.client, self.upstream]:
+                if i is None:
+                    continue
+                try:
+                    i.shutdown(socket.SHUT_RDWR)  # будит поток, читающий с другой стороны
+                except OSError:
+                    pass
+                i.close()
+        finally:
+            self.lock.release()
+        if self.join is not None and self.shard is not None:
+            self.router.remember(self.join['name'], self.shard)
+
+
+class Router:
+    def __init__(self, port, shards, secret, isLocal=True):
+        self.port = int(os.environ.get("PORT", port))
+        self.shards = parse_shards(os.environ.get("SHARDS", shards))
+        self.secret = os.environ.get("SHARD_SECRET", secret)
+        if not self.secret:
+            raise ValueError('SHARD_SECRET is required')
+        self.ip = '127.0.0.1' if isLocal else '0.0.0.0'
+        print(self.ip, self.port)
+        self.directory = {}  # имя игрока -> сервер, на котором он был последним
+        self.directory_lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((self.ip, self.port))
+        self.socket.listen(40)
+        self.running = True
+
+    def locate(self, name):
+        self.directory_lock.acquire()
+        try:
+            if name in self.directory:
+                return self.directory[name]
+        finally:
+            self.directory_lock.release()
+        return find_shard(self.shards, SPAWN_X) or self.shards[0][1]  # не тот сервер сам передаст игрока дальше
+
+    def remember(self, name, shard):
+        self.directory_lock.acquire()
+        try:
+            self.directory[name] = shard
+        finally:
+            self.directory_lock.release()
+
+    def run(self):
+        while self.running:
+            try:
+                client_sock, address = self.socket.accept()
+                client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=Session(self, client_sock).run, daemon=True).start()
+            except Exception:
+                pass
+
+    def exit(self):
+        self.running = False
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    router = Router(4400, '', '', isLocal=False)
+    router.run()
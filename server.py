@@ -13,7 +13,20 @@ from inventory import Inventory
 import socketserver
 import requests
 import flask
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from level_generation import ChunkController
+from connection import SocketConnection, StreamConnection, FrameReader, HEADER_SIZE, HIGH_PRIORITY, LOW_PRIORITY, \
+    DatagramChannel, unpack_datagram, receive_socket, READ_BUFFER_SIZE, RelayedConnection, pack_relay, unpack_relay
+from collections import deque
+from protocol import RELAY_MARK, MAX_FRAME, encode, decode, choose_codec, choose_compression, quantise_state, make_delta, HISTORY_SIZE
+from spatial_index import SpatialIndex
+from locks import CountingLock, RegionLocks
+from metrics import Metrics, GAUGE, COUNTER
+from sharding import parse_band, in_band, HANDOFF_MARGIN
+from limits import RATE_LIMITS, make_buckets
+from replica import RegionReplica, start_worker, region_frame
+import multiprocessing
 
 if getattr(sys, 'frozen', False):
     application_path = os.path.dirname(sys.executable)
@@ -22,30 +35,89 @@ else:
 sys.path.append(os.path.join(application_path, "classes"))
 
 
-player_lock = threading.Lock()
+registry_lock = CountingLock('registry')  # порядок захвата блокировок описан в locks.py
 
 
 import socket
 import threading
 import os
 import random
+import secrets
 last_id = 0
 app = flask.Flask(__name__)
 
+THREADED_MODE = 'threads'  # поток на каждого клиента
+ASYNC_MODE = 'asyncio'  # один поток с циклом событий на всех
+CLIENT_TIMEOUT = 20
+
+INTEREST_CELL = 16  # размер корзины индекса игроков
+INTEREST_MARGIN = 8  # запас вокруг окна обзора клиента
+MAX_VIEW = 64  # больший обзор клиенту не дается
+TICK_RATE = 20  # шагов сервера в секунду
+MAX_REGIONS = 32  # полос мира, на которые может быть подписан клиент
+METRICS_PORT = 0  # порт страницы /metrics, 0 - не запускать
+UDP_PORT = None  # порт udp для движения, None - тот же, что у tcp, 0 - не открывать
+SHARD_RANGE = ''  # полоса мира этого сервера "начало:конец", пусто - весь мир
+SAVE_FILE = 'save_server.txt'
+REPLICA_WORKERS = 0  # процессов, раздающих полосы мира из разделяемой памяти, 0 - полосы раздает сам сервер
+CHANGE_LOG_SIZE = 4096  # последних изменений мира, которые можно дослать вернувшемуся клиенту
+HANDLER_THREADS = 16  # потоков, в которых asyncio режим выполняет обработчики - они ждут блокировок сервера
+RELAY_SESSIONS = 256  # клиентов за одним ретранслятором, включая ретрансляторы за ним
+
 class ClientInstance:
-    def __init__(self, name, socket, address, player, id):
+    def __init__(self, name, connection, address, player, id):
         self.name = name
-        self.socket = socket
+        self.connection = connection
         self.address = address
         self.player = player
         self.id = id
         self.direction = 0
+        self.velocity = (0, 0)  # блоков в секунду, по ней клиенты двигают игрока между пингами
+        self.view = (BASE_BLOCK_WIDTH + 20, BASE_BLOCK_HEIGHT + 20)
+        self.visible = set()  # имена игроков, о которых знает клиент
+        self.watchers = set()  # имена игроков, которые знают об этом клиенте
+        self.regions = set()  # полосы мира, загруженные клиентом - изменения в них приходят ему
+        self.acked = -1  # последний шаг, который клиент подтвердил - база для разностей
+        self.sent = -1  # последний отправленный клиенту шаг
+        self.known = {}  # шаг -> имена игроков, состояния которых были у клиента на этом шаге
+        self.entered = {}  # имя -> шаг, с которого игрок снова в обзоре клиента
+        self.dirty = False  # присылал пинг с прошлого шага
+        self.datagram = None  # DatagramChannel, если клиент договорился о udp
+        self.buckets = make_buckets()  # ограничения частоты запросов, переживают переподключение
+        self.token = secrets.token_hex(16)  # по нему клиент возвращается в сессию после обрыва
+        self.lock = CountingLock(name)  # состояние и инвентарь игрока
+
+    def set_view(self, view):
+        self.view = (min(MAX_VIEW, view[0]), min(MAX_VIEW, view[1]))
+
+    def interest(self):  # прямоугольник мира, изменения в котором нужны клиенту
+        dx, dy = self.view[0] / 2 + INTEREST_MARGIN, self.view[1] / 2 + INTEREST_MARGIN
+        return self.player.x - dx, self.player.y - dy, self.player.x + dx, self.player.y + dy
+
+    def sees(self, x, y):
+        x0, y0, x1, y1 = self.interest()
+        return x0 <= x <= x1 and y0 <= y <= y1
+
+    def get_selected_type(self):
+        return self.player.inventory.get_selected().type if self.player.inventory.get_selected() is not None else 'None'
+
+    def join_data(self):
+        return {'name': self.name, 'x': self.player.x, 'y': self.player.y, 'id': self.id, 'selected': self.get_selected_type()}
+
+    def ping_data(self):
+        return {'id': self.id, 'x': self.player.x, 'y': self.player.y, 'moving': self.player.moving,
+                'dir': self.direction, 'selected': self.get_selected_type(), 'vx': self.velocity[0],
+                'vy': self.velocity[1]}
+
+    def state(self):
+        return quantise_state(self.ping_data())
 
     def ping(self, data):
         self.player.x = data['x']
         self.player.y = data['y']
         self.player.moving = data['moving']
         self.direction = data['dir']
+        self.velocity = (data.get('vx', 0), data.get('vy', 0))
         self.player.inventory.set_selected(data['selected'])
 
     def save(self):
@@ -62,45 +134,302 @@ class ClientInstance:
 
 
 class Server:
-    def __init__(self, port, isLocal=True, conections_limit=40):
+    def __init__(self, port, isLocal=True, conections_limit=40, mode=THREADED_MODE, tick_rate=TICK_RATE,
+                 metrics_port=METRICS_PORT, udp_port=UDP_PORT, band=SHARD_RANGE, channel=None, save_path=SAVE_FILE,
+                 replica_workers=REPLICA_WORKERS):
         self.port = int(os.environ.get("PORT", port))
+        self.metrics_port = int(os.environ.get("METRICS_PORT", metrics_port))
+        self.mode = os.environ.get("SERVER_MODE", mode)
+        self.tick_rate = float(os.environ.get("TICK_RATE", tick_rate))
+        self.band = parse_band(os.environ.get("SHARD_RANGE", band))
+        self.shard_secret = os.environ.get("SHARD_SECRET", '')  # им роутер подписывает передачу игрока
+        if os.environ.get("SHARD_RANGE", band) and not self.shard_secret:
+            raise ValueError('SHARD_SECRET is required together with SHARD_RANGE')
+        self.relay_secret = os.environ.get("RELAY_SECRET", '')  # пусто - ретрансляторы не принимаются
+        self.relay_sessions = int(os.environ.get("RELAY_SESSIONS", RELAY_SESSIONS))
         self.ip = '127.0.0.1' if isLocal else '0.0.0.0'
         print(self.ip, self.port)
         self.player_list = {}
         self.player_address = {}
-        self.conections_limit = conections_limit
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.ip, self.port))
-        self.socket.listen(40)
+        self.conections_limit = int(os.environ.get("CONNECTIONS_LIMIT", conections_limit))
+        self.save_path = os.environ.get("SAVE_FILE", save_path)
+        self.replica_workers = int(os.environ.get("REPLICA_WORKERS", replica_workers))
+        self.replica = None  # копия изменений мира в разделяемой памяти, создается в run
+        self.pool = None
+        self.channel = channel  # unix сокет супервизора: клиенты приходят по нему, свой порт не слушается
+        self.socket = None
+        if channel is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.bind((self.ip, self.port))
+            self.socket.listen(40)
+            self.udp_port = int(os.environ.get("UDP_PORT", self.port if udp_port is None else udp_port))
+        else:
+            self.udp_port = 0  # датаграммы супервизор не передает
+        self.udp_socket = None
+        if self.udp_port:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.bind((self.ip, self.udp_port))
+        self.datagram_transport = self.udp_socket  # в asyncio режиме заменится транспортом цикла событий
+        self.datagrams = {}  # токен udp -> ClientInstance
         self.game = Game()
         self.game.is_server = True
         self.running = True
+        self.loop = None
+        self.executor = None  # потоки обработчиков в asyncio режиме, цикл событий блокировок не ждет
+        self.outgoing = deque()  # сообщения, ждущие рассылки
+        self.broadcast_lock = threading.Lock()
+        self.players_index = SpatialIndex(INTEREST_CELL)
+        self.block_changes = deque()  # (сообщение, x, y, id автора) с прошлого шага
+        self.region_locks = RegionLocks()
+        self.metrics = Metrics()
+        self.tick_seq = 0
+        self.history = {}  # шаг -> {имя: состояние игрока}, базы для разностей
+        self.change_seq = 0  # номер последнего разосланного изменения мира
+        self.change_log = deque(maxlen=int(os.environ.get("CHANGE_LOG_SIZE", CHANGE_LOG_SIZE)))  # (номер, полоса, сообщение)
+        self.region_changes = {}  # полоса -> номер ее последнего изменения
         self.last_id = 0
-        self.game.chunk_controller = ChunkController(1, 1, random.randint(0, 100000))
-        self.routing = {BLOCK_UPDATE: self.block_update, JOIN_REQUEST: self.handle_join, LEAVE_REQUEST: self.handle_leave, PLACE_BLOCK: self.block_place, DESTROY_BLOCK: self.block_destroy, PING: self.ping, SYNC_INVENTORY: self.sync_inventory, SYNC_BLOCK: self.sync_block}
+        self.game.chunk_controller = ChunkController(1, 1, int(os.environ.get("SEED", random.randint(0, 100000))))
+        self.routing = {BLOCK_UPDATE: self.block_update, JOIN_REQUEST: self.handle_join, LEAVE_REQUEST: self.handle_leave, PLACE_BLOCK: self.block_place, DESTROY_BLOCK: self.block_destroy, PING: self.ping, SYNC_INVENTORY: self.sync_inventory, SYNC_BLOCK: self.sync_block, ACK: self.ack, REGION_REQUEST: self.region_request, ECHO: self.echo, CHECKSUM: self.checksum, RELAY_AUTH: self.relay_auth}
+
+    def owns(self, x):  # менять блоки можно только в своей полосе
+        return in_band(self.band, x)
 
-    def block_update(self, data, address, socket):
-        player_lock.acquire()
+    def block_update(self, data, address, connection):
+        if not self.owns(data['x']):
+            return
+        source = self.source_id(address)
+        locks = self.region_locks.acquire([self.game.chunk_controller.get_region(data['x'])])
         try:
             new = self.game.objects[data['type']].generate_block(**data)
             self.game.chunk_controller.place_block(data['x'], data['y'], new, self.game)
-            self.send_all({'request': BLOCK_UPDATE, 'data': {'x': data['x'], 'y': data['y'],
-                                                             'block': new.save()}}, address)
+            self.change_block({'request': BLOCK_UPDATE, 'data': {'x': data['x'], 'y': data['y'],
+                                                                 'block': new.save()}}, data['x'], data['y'], source)
         finally:
-            player_lock.release()
+            self.region_locks.release(locks)
 
-    def send_all(self, data, except_address=None):  # requires to be called in player_lock.acquire() context
-        for i in self.player_address.values():
-            if self.player_list[i].address == except_address:
-                continue
-            try:
-                self.send(self.player_list[i].socket, data)
-            except Exception as e:
-                print(e)
+    def send_all(self, data, except_address=None, priority=HIGH_PRIORITY):  # requires to be called in registry_lock.acquire() context
+        self.post(data, [self.player_list[i].connection for i in self.player_address.values()
+                         if self.player_list[i].address != except_address], priority)
+
+    def get_client(self, address):
+        registry_lock.acquire()
+        try:
+            return self.player_list[self.player_address[address]]
+        finally:
+            registry_lock.release()
+
+    def source_id(self, address):
+        registry_lock.acquire()
+        try:
+            return self.player_list[self.player_address[address]].id if address in self.player_address else None
+        finally:
+            registry_lock.release()
+
+    def lock_stats(self):  # имя -> (захватов, ожиданий, секунд ожидания)
+        registry_lock.acquire()
+        try:
+            res = {'players': (sum(i.lock.acquired for i in self.player_list.values()),
+                               sum(i.lock.contended for i in self.player_list.values()),
+                               sum(i.lock.waited for i in self.player_list.values()))}
+        finally:
+            registry_lock.release()
+        res['registry'] = (registry_lock.acquired, registry_lock.contended, registry_lock.waited)
+        res['regions'] = self.region_locks.stats()
+        return res
+
+    def gauges(self):  # текущие значения для /metrics
+        res = []
+        for name, (acquired, contended, waited) in self.lock_stats().items():
+            res.append(('lock_acquired_total', COUNTER, (('lock', name),), acquired))
+            res.append(('lock_contended_total', COUNTER, (('lock', name),), contended))
+            res.append(('lock_wait_seconds_total', COUNTER, (('lock', name),), waited))
+        registry_lock.acquire()
+        try:
+            clients = [self.player_list[i] for i in self.player_address.values()]
+            res.append(('connected_players', GAUGE, (), len(clients)))
+            for i in clients:
+                res.append(('client_received_bytes_total', COUNTER, (('player', i.name),), i.connection.bytes_in))
+                res.append(('client_sent_bytes_total', COUNTER, (('player', i.name),), i.connection.bytes_out))
+                res.append(('client_queued_bytes', GAUGE, (('player', i.name),), i.connection.queued))
+                res.append(('client_dropped_messages_total', COUNTER, (('player', i.name),), i.connection.dropped))
+                if i.datagram is not None:
+                    res.append(('client_datagram_received_bytes_total', COUNTER, (('player', i.name),), i.datagram.bytes_in))
+                    res.append(('client_datagram_sent_bytes_total', COUNTER, (('player', i.name),), i.datagram.bytes_out))
+        finally:
+            registry_lock.release()
+        changes = self.game.chunk_controller.changes
+        res.append(('changed_blocks', GAUGE, (), sum(len(i) for i in list(changes.values()))))
+        res.append(('changed_columns', GAUGE, (), len(changes)))
+        return res
+
+    def change_block(self, data, x, y, source=None):  # изменение уйдет на ближайшем шаге, автору - только если source None
+        self.block_changes.append((data, x, y, source))
+
+    def watchers_of(self, x, y):  # имена игроков, в чью область интереса попадает точка
+        radius = MAX_VIEW / 2 + INTEREST_MARGIN
+        return set(i for i in self.players_index.query(x - radius, y - radius, x + radius, y + radius)
+                   if self.player_list[i].sees(x, y))
+
+    def show(self, watcher, target):
+        watcher.visible.add(target.name)
+        watcher.entered[target.name] = self.tick_seq + 1  # клиент забыл игрока при выходе, нужно полное состояние
+        target.watchers.add(watcher.name)
+        self.post({'request': JOIN, 'data': target.join_data()}, [watcher.connection])
+
+    def hide(self, watcher, target):
+        watcher.visible.discard(target.name)
+        target.watchers.discard(watcher.name)
+        self.post({'request': LEAVE, 'data': {'id': target.id}}, [watcher.connection])
+
+    def update_interest(self, client):  # после перемещения игроки входят в области интереса друг друга и выходят из них
+        self.players_index.update(client.name, client.player.x, client.player.y)
+        watchers = self.watchers_of(client.player.x, client.player.y) - {client.name}
+        for i in watchers - client.watchers:
+            self.show(self.player_list[i], client)
+        for i in client.watchers - watchers:
+            self.hide(self.player_list[i], client)
+        visible = set(self.players_index.query(*client.interest())) - {client.name}
+        for i in visible - client.visible:
+            self.show(client, self.player_list[i])
+        for i in client.visible - visible:
+            self.hide(client, self.player_list[i])
+
+    def tick(self):  # шаг сервера: каждому клиенту уходят разности с подтвержденной им базой
+        leaving = []  # ушли за полосу сервера
+        registry_lock.acquire()
+        try:
+            clients = [self.player_list[i] for i in self.player_address.values()]
+            states = {}
+            players = []
+            synced = True
+            subscribed = set()  # полосы, на которые кто-то подписан
+            for client in clients:  # игроки блокируются по одному, две блокировки игроков сразу не берутся
+                client.lock.acquire()
+                try:
+                    states[client.name] = client.state()
+                    subscribed |= client.regions
+                    if client.dirty:
+                        players.append(client)
+                    client.dirty = False
+                    synced = synced and client.acked == client.sent
+                    if not in_band(self.band, client.player.x, HANDOFF_MARGIN):
+                        leaving.append(client)
+                finally:
+                    client.lock.release()
+            blocks = [self.block_changes.popleft() for i in range(len(self.block_changes))]
+            for data, x, y, source in blocks:
+                self.change_seq += 1
+                self.change_log.append((self.change_seq, self.game.chunk_controller.get_region(x), data))
+                self.region_changes[self.game.chunk_controller.get_region(x)] = self.change_seq
+            if self.replica is not None:  # копия обновляется до рассылки, см. deliver_region
+                self.publish_regions(blocks)
+                for i in list(self.replica.segments.keys() - subscribed):  # ничьи полосы не держат память и дескрипторы
+                    self.replica.evict(i)
+            for i in players:
+                self.update_interest(i)
+            if not players and not blocks and synced and not leaving:
+                return  # все уже знают текущее состояние
+            self.tick_seq += 1
+            seq = self.tick_seq
+            stamp = time.time()  # по нему клиенты расставляют положения игроков во времени
+            self.history[seq] = states
+            self.history.pop(seq - HISTORY_SIZE, None)
+            groups = {}  # клиенты с одинаковыми разностями получают одни и те же байты
+            for client in clients:
+                client.lock.acquire()
+                try:
+                    key = self.snapshot_key(client, seq, states, blocks)
+                finally:
+                    client.lock.release()
+                if key is not None:
+                    groups.setdefault(key, []).append(client)
+            for (base, changes, entries), members in groups.items():  # только движение можно терять - оно идет по udp
+                self.post({'request': SNAPSHOT, 'data': {'seq': seq, 'base': base, 'time': stamp, 'change': self.change_seq,
+                                                         'players': [dict(i) for i in entries],
+                                                         'blocks': [[blocks[i][3], blocks[i][0]] for i in changes]}},
+                          [i.connection if changes or i.datagram is None else i.datagram for i in members],
+                          HIGH_PRIORITY if changes else LOW_PRIORITY)
+        finally:
+            registry_lock.release()
+        for i in leaving:
+            self.hand_off(i)
+        self.flush()
+
+    def snapshot_key(self, client, seq, states, blocks):  # что получит клиент на этом шаге, None - ничего
+        base = client.acked if client.acked in self.history and client.acked in client.known else -1
+        content = client.visible | {client.name}
+        entries = []
+        for name in content:
+            old = None
+            if base != -1 and name in client.known[base] and client.entered.get(name, 0) <= base:
+                old = self.history[base][name]
+            entry = make_delta(self.player_list[name].id, old, states[name])
+            if entry is not None:
+                entries.append(entry)
+        changes = []
+        for ind, (data, x, y, source) in enumerate(blocks):
+            if self.game.chunk_controller.get_region(x) in client.regions:
+                changes.append(ind)
+        if not entries and not changes:
+            return None
+        client.known[seq] = content
+        client.sent = seq
+        for i in [i for i in client.known if i <= seq - HISTORY_SIZE]:
+            client.known.pop(i)
+        return base, tuple(changes), tuple(tuple(sorted(i.items())) for i in entries)
+
+    def tick_loop(self):
+        next_tick = time.time()
+        while self.running:
+            self.tick()
+            next_tick += 1 / self.tick_rate
+            time.sleep(max(0, next_tick - time.time()))
+
+    async def tick_task(self):
+        next_tick = time.time()
+        while self.running:
+            await self.loop.run_in_executor(self.executor, self.tick)
+            next_tick += 1 / self.tick_rate
+            await asyncio.sleep(max(0, next_tick - time.time()))
+
+    def post(self, data, connections, priority=HIGH_PRIORITY):  # под блокировками только запоминается, отправит flush
+        self.outgoing.append((data, connections, priority))
+
+    def flush(self):  # рассылка вне блокировок в том же порядке, в котором сообщения были поставлены
+        self.broadcast_lock.acquire()
+        try:
+            while self.outgoing:
+                data, connections, priority = self.outgoing.popleft()
+                frames = {}  # сообщение кодируется один раз для каждого кодека и сжатия
+                relayed = {}  # (ретранслятор, кодек, сжатие) -> номера сессий: ретранслятору уходит одна копия
+                for connection in connections:
+                    try:
+                        key = (connection.codec, connection.compression)
+                        if key not in frames:  # пакеты от помощников уже закодированы для своего клиента
+                            frames[key] = data if isinstance(data, bytes) else encode(data, connection.codec, connection.compression)
+                        if isinstance(connection, RelayedConnection):
+                            if not connection.closed:
+                                connection.bytes_out += len(frames[key])
+                                relayed.setdefault((connection.relay,) + key, []).append(connection.id)
+                            continue
+                        connection.send(frames[key], priority)
+                    except Exception as e:
+                        print(e)
+                for (relay, codec, compression), ids in relayed.items():
+                    relay.send(pack_relay(ids, frames[(codec, compression)], priority), priority)
+        finally:
+            self.broadcast_lock.release()
 
-    def handle_join(self, data, address, socket):
-        player_lock.acquire()
+    def handle_join(self, data, address, connection):
+        registry_lock.acquire()
         try:
+            resume = data.get('resume')
+            old = self.player_list.get(data['name'])
+            if resume is not None and (old is None or not secrets.compare_digest(old.token.encode(), str(resume.get('token', '')).encode())):
+                resume = None  # сервер перезапускался или сессия чужая - обычный вход
+            if resume is not None and self.player_address.get(old.address) == old.name:
+                self.remove(old)  # старое соединение еще не заметило обрыва
+                old.connection.close()
             if address in self.player_address:
                 return {
                     'success': False,
@@ -111,9 +440,15 @@ class Server:
                     'success': False,
                     'reason': '[server connection error]: Name ' + data['name'] + 'already taken'
                 }
+            if len(self.player_address) >= self.conections_limit:
+                self.metrics.inc('joins_rejected_total', (('reason', 'full'),))
+                return {
+                    'success': False,
+                    'reason': '[server connection error]: Server is full (' + str(self.conections_limit) + ' players)'
+                }
             self.player_address[address] = data['name']
             if data['name'] not in self.player_list:
-                self.player_list[data['name']] = ClientInstance(data['name'], socket, address, Player(100000, self.game.chunk_controller.get_player_start_pos(100000), Inventory(9, 3, self.game.crafts, self.game), self.game), self.last_id)
+                self.player_list[data['name']] = ClientInstance(data['name'], connection, address, Player(100000, self.game.chunk_controller.get_player_start_pos(100000), Inventory(9, 3, self.game.crafts, self.game), self.game), self.last_id)
                 player = self.player_list[data['name']].player
                 self.last_id += 1
                 try:
@@ -124,73 +459,279 @@ class Server:
             else:
                 player = self.player_list[data['name']].player
                 self.player_list[data['name']].name = data['name']
-                self.player_list[data['name']].socket = socket
+                self.player_list[data['name']].connection = connection
                 self.player_list[data['name']].address = address
-            level = self.game.gen_save()
-            self.send_all({'request': JOIN,
-                           'data': {
-                                'name': self.player_list[data['name']].name,
-                                'x': player.x,
-                                'y': player.y,
-                                'id': self.player_list[data['name']].id,
-                                'selected': player.inventory.get_selected().type if player.inventory.get_selected() is not None else 'None'}}, address)
+            client = self.player_list[data['name']]
+            handoff = data.get('handoff') if self.shard_secret and \
+                secrets.compare_digest(str(data.get('secret', '')).encode(), self.shard_secret.encode()) else None
+            connection.codec = choose_codec(data.get('codecs', []))
+            connection.compression = choose_compression(data.get('compression', []))
+            client.visible, client.watchers = set(), set()
+            self.datagrams.pop(client.datagram.token if client.datagram is not None else None, None)
+            client.datagram = None
+            if data.get('udp') and self.udp_socket is not None and not isinstance(connection, RelayedConnection):  # токен связывает датаграммы с этим игроком
+                client.datagram = DatagramChannel(connection, secrets.randbits(64), self.datagram_transport)
+                self.datagrams[client.datagram.token] = client
+            client.lock.acquire()
+            try:
+                client.set_view(data.get('view', client.view))
+                client.regions = set()  # мир клиент запросит полосами
+                replay = []
+                if resume is not None and self.can_replay(resume.get('change', -1)):  # полосы клиента досылаются из журнала
+                    client.regions = set(resume.get('regions', [])[:MAX_REGIONS])
+                    replay = [message for seq, region, message in self.change_log
+                              if seq > resume['change'] and region in client.regions]
+                client.acked, client.sent, client.known, client.entered = -1, -1, {}, {}  # у нового соединения нет базы
+                if handoff is not None:  # игрок пришел с соседней полосы со своим положением и инвентарем
+                    player.load(handoff)
+                player_data = player.save()
+            finally:
+                client.lock.release()
+            self.players_index.update(client.name, player.x, player.y)
+            for i in self.watchers_of(player.x, player.y) - {client.name}:
+                self.show(self.player_list[i], client)
+            client.visible = set(self.players_index.query(*client.interest())) - {client.name}
+            for i in client.visible:
+                self.player_list[i].watchers.add(client.name)
             to_return = {
                 'success': True,
-                'level': level,
-                'players': [{
-                    'id': self.player_list[i].id,
-                    'name': self.player_list[i].name,
-                    'x': self.player_list[i].player.x,
-                    'y': self.player_list[i].player.y,
-                    'selected': self.player_list[i].player.inventory.get_selected().type if self.player_list[i].player.inventory.get_selected() is not None else 'None'} for i in self.player_address.values() if self.player_list[i].id != self.player_list[data['name']].id],
-                'player_data': player.save(),
-                'started_time': time.time() - self.game.started_time
+                'seed': self.game.chunk_controller.seed,
+                'players': [self.player_list[i].join_data() for i in client.visible],
+                'player_data': player_data,
+                'started_time': time.time() - self.game.started_time,
+                'codec': connection.codec,
+                'compression': connection.compression,
+                'udp': {'port': self.udp_port, 'token': client.datagram.token} if client.datagram is not None else None,
+                'id': client.id,
+                'resume': client.token,
+                'change': self.change_seq,
+                'regions': sorted(client.regions),  # полосы, которые не нужно загружать заново
+                'replay': replay
             }
-            return to_return
+            self.post(to_return, [connection])  # ответ должен прийти раньше пакетов, разосланных после входа
 
         finally:
-            player_lock.release()
+            registry_lock.release()
+
+    def can_replay(self, change):  # requires to be called in registry_lock.acquire() context
+        oldest = self.change_log[0][0] if self.change_log else self.change_seq + 1
+        return oldest - 1 <= change <= self.change_seq  # журнал помнит все изменения после change
 
-    def ping(self, data, address, socket):
-        player_lock.acquire()
+    def ping(self, data, address, connection):
         try:
-            name = self.player_address[address]
-            self.player_list[name].ping(data)
-            self.send_all({'request': PING,
-                           'data': {
-                               'id': self.player_list[name].id,
-                               'x': self.player_list[name].player.x,
-                               'y': self.player_list[name].player.y,
-                               'moving': self.player_list[name].player.moving,
-                               'dir': self.player_list[name].direction,
-                               'selected': self.player_list[name].player.inventory.get_selected().type if self.player_list[name].player.inventory.get_selected() is not None else 'None'}}, address)
+            client = self.get_client(address)
+            client.lock.acquire()
+            try:
+                client.ping(data)
+                client.dirty = True  # разошлется на ближайшем шаге
+            finally:
+                client.lock.release()
         except Exception as E:
             print(E)
+
+    def region_request(self, data, address, connection):  # клиент подгружает полосы мира по мере движения
+        if self.pool is not None:
+            return self.region_request_replica(data, address, connection)
+        client = self.get_client(address)
+        load = data.get('load', [])[:MAX_REGIONS]
+        locks = self.region_locks.acquire(load)
+        try:
+            client.lock.acquire()
+            try:
+                for i in data.get('unload', []):
+                    client.regions.discard(i)
+                for i in load:
+                    if len(client.regions) >= MAX_REGIONS:
+                        break
+                    client.regions.add(i)
+                    self.post({'request': REGION, 'data': {'region': i, 'changes': self.game.chunk_controller.save_region(i)}},
+                              [connection])
+            finally:
+                client.lock.release()
+        finally:
+            self.region_locks.release(locks)
+
+    def region_request_replica(self, data, address, connection):  # полосы кодируют помощники, сервер только подписывает
+        load = data.get('load', [])[:MAX_REGIONS]
+        added = []
+        registry_lock.acquire()  # версии копии сравниваются под ней же, см. deliver_region
+        try:
+            client = self.player_list[self.player_address[address]]
+            locks = self.region_locks.acquire(load)
+            try:
+                client.lock.acquire()
+                try:
+                    for i in data.get('unload', []):
+                        client.regions.discard(i)
+                    for i in load:
+                        if len(client.regions) >= MAX_REGIONS:
+                            break
+                        client.regions.add(i)
+                        added.append(i)
+                finally:
+                    client.lock.release()
+                for i in added:  # снимок полосы пишется при первом запросе и когда ее журнал стал длинным
+                    if i not in self.replica.published or not self.replica.compacted(i):
+                        self.replica.publish(i, json.dumps(self.game.chunk_controller.save_region(i)).encode())
+            finally:
+                self.region_locks.release(locks)
+        finally:
+            registry_lock.release()
+        for i in added:
+            self.request_region(client, connection, i)
+
+    def publish_regions(self, blocks):  # requires to be called in registry_lock.acquire() context
+        cells = {}  # полоса -> клетки, измененные за шаг
+        for data, x, y, source in blocks:
+            region = self.game.chunk_controller.get_region(x)
+            if region in self.replica.published:  # полосу еще никто не запрашивал - запишется при первом запросе
+                cells.setdefault(region, set()).add((x, y))
+        for region, points in cells.items():  # в журнал полосы дописываются только эти клетки
+            record = {}
+            locks = self.region_locks.acquire([region])
+            try:
+                for x, y in points:
+                    block = self.game.chunk_controller.changes.get(x, {}).get(y)
+                    if block is not None:
+                        record.setdefault(x, {})[y] = block.save()
+            finally:
+                self.region_locks.release(locks)
+            self.replica.append(region, json.dumps(record).encode())
+
+    def request_region(self, client, connection, region):
+        self.pool.apply_async(region_frame, (region, connection.codec, connection.compression),
+                              callback=lambda res: self.deliver_region(client, connection, *res),
+                              error_callback=lambda e: self.fallback_region(client, connection, region, e))
+
+    def fallback_region(self, client, connection, region, error):  # помощник не прочитал полосу - ее отдает сам сервер
+        print(error)
+        self.metrics.inc('region_replica_errors_total')
+        registry_lock.acquire()
+        try:
+            if self.player_address.get(client.address) != client.name or client.connection is not connection:
+                return  # клиент ушел
+            locks = self.region_locks.acquire([region])
+            try:
+                client.lock.acquire()
+                try:
+                    subscribed = region in client.regions
+                finally:
+                    client.lock.release()
+                if subscribed:
+                    self.post({'request': REGION, 'data': {'region': region, 'changes': self.game.chunk_controller.save_region(region)}},
+                              [connection])
+            finally:
+                self.region_locks.release(locks)
+        finally:
+            registry_lock.release()
+        self.flush()
+
+    def deliver_region(self, client, connection, region, version, frame):  # в потоке результатов пула
+        registry_lock.acquire()
+        try:
+            if self.replica is None or self.player_address.get(client.address) != client.name \
+                    or client.connection is not connection:
+                return  # клиент ушел
+            if self.replica.version(region) != version:  # полоса изменилась после чтения: изменения могли уже уйти
+                self.metrics.inc('region_replica_stale_total')
+                self.request_region(client, connection, region)
+                return
+            client.lock.acquire()
+            try:
+                subscribed = region in client.regions
+            finally:
+                client.lock.release()
+            if subscribed:
+                self.post(frame, [connection])
+                self.metrics.inc('region_replica_sent_total')
         finally:
-            player_lock.release()
+            registry_lock.release()
+        self.flush()
 
-    def send(self, socket, data):
-        prep = bytes(json.dumps(data), encoding='ascii')
-        socket.send(len(prep).to_bytes(16, 'big'))
-        socket.send(prep)
+    def start_replica(self):
+        if not self.replica_workers:
+            return
+        self.replica = RegionReplica()
+        self.pool = multiprocessing.get_context('spawn').Pool(self.replica_workers, start_worker, (self.replica.prefix,))
+
+    def checksum(self, data, address, connection):  # клиент сверяет свои полосы, в ответ - хэши полос, если корень разошелся
+        regions = data['regions'][:MAX_REGIONS]
+        registry_lock.acquire()
+        try:
+            if data['change'] > self.change_seq:
+                return None  # номер не от этого сервера
+            if any(self.region_changes.get(i, 0) > data['change'] for i in regions):
+                return None  # изменения этих полос до клиента еще не дошли, сравнивать рано
+            locks = self.region_locks.acquire(regions)
+            try:
+                pending = set(self.game.chunk_controller.get_region(i[1]) for i in list(self.block_changes))  # копия: другие полосы дописывают без нас
+                if pending & set(regions):
+                    return None  # изменения еще не разосланы
+                hashes = [[i, self.game.chunk_controller.region_hash(i)] for i in regions]
+            finally:
+                self.region_locks.release(locks)
+        finally:
+            registry_lock.release()
+        root = 0
+        for region, value in hashes:
+            root ^= value
+        if root == data['root']:
+            self.metrics.inc('checksums_total', (('result', 'match'),))
+            return None
+        self.metrics.inc('checksums_total', (('result', 'mismatch'),))
+        return {'request': CHECKSUM, 'data': {'change': data['change'], 'hashes': hashes}}
 
-    def receive(self, socket):
-        ln = int.from_bytes(socket.recv(16), 'big')
-        data = json.loads(socket.recv(ln))
-        return data
+    def relay_auth(self, data, address, connection):  # клиент за ретранслятором сам ретранслятором не станет
+        success = bool(self.relay_secret) and not isinstance(connection, RelayedConnection) and \
+            secrets.compare_digest(self.relay_secret.encode(), str(data.get('secret', '')).encode())
+        self.metrics.inc('relay_auth_total', (('result', 'accepted' if success else 'rejected'),))
+        if not success:
+            return {'request': RELAY_AUTH, 'data': {'success': False, 'reason': 'wrong relay secret'}}
+        connection.relay = True
+        return {'request': RELAY_AUTH, 'data': {'success': True}}
+
+    def echo(self, data, address, connection):  # замер задержки: ответ проходит тот же путь, что и остальные сообщения
+        return {'request': ECHO, 'data': data}
+
+    def ack(self, data, address, connection):
+        client = self.get_client(address)
+        client.lock.acquire()
+        try:
+            if data['seq'] in client.known and data['seq'] > client.acked:
+                client.acked = data['seq']
+        finally:
+            client.lock.release()
+
+    def send(self, connection, data):
+        connection.send(encode(data, connection.codec, connection.compression))
+
+    async def receive_stream(self, reader, connection):
+        ln = int.from_bytes(await reader.readexactly(HEADER_SIZE), 'big')
+        if ln > MAX_FRAME:
+            raise ConnectionError('frame of ' + str(ln) + ' bytes')
+        frame = await reader.readexactly(ln)
+        connection.bytes_in += HEADER_SIZE + ln
+        return frame
 
     def save(self):
         data = {
         'game': self.game.gen_save(),
-        'players': [i.save() for i in self.player_list.values()],
+        'players': [self.save_player(i) for i in self.player_list.values()],
         'last_id': self.last_id
         }
-        out = open('save_server.txt', 'w')
+        out = open(self.save_path, 'w')
         out.write(json.dumps(data))
         out.close()
 
+    def save_player(self, client):
+        client.lock.acquire()
+        try:
+            return client.save()
+        finally:
+            client.lock.release()
+
     def load(self):
-        inp = open('save_server.txt', 'r')
+        inp = open(self.save_path, 'r')
         data = json.loads(inp.read())
         self.game.gen_load(data['game'])
         self.last_id = data['last_id']
@@ -199,104 +740,383 @@ class Server:
             self.player_list[i['name']].load(i)
         inp.close()
 
-    def handle_leave(self, data, address, socket):
-        player_lock.acquire()
+    def handle_leave(self, data, address, connection):
+        registry_lock.acquire()
+        try:
+            if address not in self.player_address:
+                return  # сессию уже забрал вход с токеном
+            self.remove(self.player_list[self.player_address[address]])
+        finally:
+            registry_lock.release()
+
+    def remove(self, client):  # requires to be called in registry_lock.acquire() context
+        self.player_address.pop(client.address)
+        self.players_index.discard(client.name)
+        if client.datagram is not None:
+            self.datagrams.pop(client.datagram.token, None)
+            client.datagram = None
+        for i in list(client.watchers):
+            self.hide(self.player_list[i], client)
+        for i in client.visible:
+            self.player_list[i].watchers.discard(client.name)
+        client.visible = set()
+
+    def hand_off(self, client):  # игрок ушел из полосы: роутер переведет его на сервер соседней полосы
+        registry_lock.acquire()
+        try:
+            if self.player_address.get(client.address) != client.name:
+                return  # успел выйти сам
+            client.lock.acquire()
+            try:
+                player_data = client.player.save()
+            finally:
+                client.lock.release()
+            self.post({'request': HANDOFF, 'data': {'name': client.name, 'x': player_data['x'], 'player': player_data}},
+                      [client.connection])
+            self.remove(client)
+            self.player_list.pop(client.name)  # теперь игрок принадлежит другому серверу
+        finally:
+            registry_lock.release()
+        self.metrics.inc('handoffs_total')
+
+    def leave(self, address, connection):
+        if connection.evicted is not None:  # сервер сам отключил отставшего клиента
+            self.metrics.inc('evicted_total', (('reason', connection.evicted),))
+        try:
+            self.handle_leave(None, address, connection)
+        finally:
+            self.flush()
+
+    def allow(self, request, address):  # тратит токен игрока на частый запрос
+        registry_lock.acquire()
         try:
-            id = self.player_list[self.player_address[address]].id
-            self.player_address.pop(address)
-            self.send_all({'request': LEAVE, 'data': {'id': id}})
+            client = self.player_list.get(self.player_address.get(address))
         finally:
-            player_lock.release()
+            registry_lock.release()
+        if client is None:
+            return True
+        client.lock.acquire()
+        try:
+            return client.buckets[request].take()
+        finally:
+            client.lock.release()
 
-    def sync_inventory(self, data, address, socket):
-        player_lock.acquire()
+    def sync_inventory(self, data, address, connection):
+        client = self.get_client(address)
+        client.lock.acquire()
         try:
-            self.player_list[self.player_address[address]].player.inventory.get_sync(data, self.game.objects)
+            client.player.inventory.get_sync(data, self.game.objects)
         finally:
-            player_lock.release()
+            client.lock.release()
 
-    def sync_block(self, data, address, socket):
-        player_lock.acquire()
+    def sync_block(self, data, address, connection):
+        if not self.owns(data['x']):
+            return
+        source = self.source_id(address)
+        locks = self.region_locks.acquire([self.game.chunk_controller.get_region(data['x'])])
         try:
             block = self.game.chunk_controller.get(data['x'], data['y'], self.game.objects, self.game)
             block.get_sync(data['block'])
-            self.send_all({'request': SYNC_BLOCK, 'data': block.get_sync_with_server()}, address)
+            self.change_block({'request': SYNC_BLOCK, 'data': block.get_sync_with_server()}, data['x'], data['y'], source)
         finally:
-            player_lock.release()
+            self.region_locks.release(locks)
 
-    def block_place(self, data, address, socket):
-        player_lock.acquire()
+    def edit_result(self, data, accepted, block=None, items=()):  # ответ на изменение с номером, без номера ответа нет
+        if not accepted:
+            self.metrics.inc('edits_rejected_total')
+        if 'seq' not in data:
+            return None
+        return {'request': EDIT_ACK, 'data': {'seq': data['seq'], 'ok': accepted, 'block': block.save() if accepted else None,
+                                              'items': [list(i) for i in items]}}  # items - изменения инвентаря [тип, число]
+
+    def block_place(self, data, address, connection):
+        if not self.owns(data['x']):
+            return self.edit_result(data, False)
+        client = self.get_client(address)
+        locks = self.region_locks.acquire([self.game.chunk_controller.get_region(data['x'])])
         try:
-            player = self.player_list[self.player_address[address]].player
-            new = self.game.objects[player.inventory.get_selected().type].generate_block(0, 0, (data['x'], data['y']))
-            player.inventory.place_selected()
+            if self.game.chunk_controller.get(data['x'], data['y'], self.game.objects, self.game).type != 'empty':
+                return self.edit_result(data, False)  # клетку успел занять другой игрок
+            client.lock.acquire()
+            try:
+                selected = client.player.inventory.get_selected()
+                if selected is None or selected.is_item:
+                    return self.edit_result(data, False)
+                new = self.game.objects[selected.type].generate_block(0, 0, (data['x'], data['y']))
+                client.player.inventory.place_selected()
+            finally:
+                client.lock.release()
             self.game.chunk_controller.place_block(data['x'], data['y'], new, self.game)
-            self.send_all({'request': BLOCK_UPDATE, 'data': {'x': data['x'], 'y': data['y'], 'block': new.save()}}, address)
+            self.change_block({'request': BLOCK_UPDATE, 'data': {'x': data['x'], 'y': data['y'], 'block': new.save()}},
+                              data['x'], data['y'], client.id)
+            return self.edit_result(data, True, new, [(new.type, -1)])
         finally:
-            player_lock.release()
+            self.region_locks.release(locks)
 
-    def block_destroy(self, data, address, socket):
-        player_lock.acquire()
+    def block_destroy(self, data, address, connection):
+        if not self.owns(data['x']):
+            return self.edit_result(data, False)
+        client = self.get_client(address)
+        locks = self.region_locks.acquire([self.game.chunk_controller.get_region(data['x'])])
         try:
             block = self.game.chunk_controller.get(data['x'], data['y'], self.game.objects, self.game)
-            player = self.player_list[self.player_address[address]].player
+            if block.type == 'empty':
+                return self.edit_result(data, False)  # блок уже сломал другой игрок
+            items = []
             if block.drop is not None:
                 drop = block.drop.get_drop()
-                player.inventory.add_item(self.game.objects[drop[0]].generate_item(drop[1]))
+                client.lock.acquire()
+                try:
+                    client.player.inventory.add_item(self.game.objects[drop[0]].generate_item(drop[1]))
+                finally:
+                    client.lock.release()
+                items.append(drop)
             new = self.game.objects['empty'].generate_block(0, 0, (data['x'], data['y']))
             self.game.chunk_controller.place_block(data['x'], data['y'], new, self.game)
-            self.send_all({'request': BLOCK_UPDATE, 'data': {'x': data['x'], 'y': data['y'],
-                                                             'block': new.save()}})
+            self.change_block({'request': BLOCK_UPDATE, 'data': {'x': data['x'], 'y': data['y'],
+                                                                 'block': new.save()}}, data['x'], data['y'])
+            return self.edit_result(data, True, new, items)
+        finally:
+            self.region_locks.release(locks)
+
+    def handle_request(self, request, address, connection):  # общая часть для обоих режимов, False - клиент ушел
+        if request['request'] == LEAVE_REQUEST:
+            self.metrics.inc('messages_total', (('handler', 'leave'),))
+            self.leave(address, connection)
+            return False
+        handler = self.routing[request['request']]
+        if request['request'] in RATE_LIMITS and not self.allow(request['request'], address):
+            self.metrics.inc('rate_limited_total', (('handler', handler.__name__),))
+            if request['request'] in (PLACE_BLOCK, DESTROY_BLOCK):  # предсказанное изменение клиент откатит
+                rejected = self.edit_result(request['data'], False)
+                if rejected:
+                    self.send(connection, rejected)
+            return True  # запрос просто отбрасывается, клиент остается
+        start = time.perf_counter()
+        try:
+            data = handler(request['data'], address, connection)
         finally:
-            player_lock.release()
+            labels = (('handler', handler.__name__),)
+            self.metrics.inc('messages_total', labels)
+            self.metrics.observe('handler_seconds', time.perf_counter() - start, labels)
+            self.flush()
+        if data:
+            self.send(connection, data)
+        return True
 
-    def handle_client_connection(self, client_socket, address):
+    def handle_frame(self, frame, address, connection, sessions):  # False - клиент ушел
+        if frame[0] == RELAY_MARK:  # пакет клиента за ретранслятором, сам ретранслятор остается
+            if not connection.relay:
+                raise ConnectionError('relay envelope before RELAY_AUTH')
+            self.handle_relayed(frame, address, connection, sessions)
+            return True
+        request = decode(frame, connection.compression)
+        if not request:
+            self.leave(address, connection)
+            return False
+        return self.handle_request(request, address, connection)
+
+    def handle_relayed(self, frame, address, connection, sessions):  # sessions - номер -> RelayedConnection этого ретранслятора
+        ids, priority, inner = unpack_relay(frame)
+        id = ids[0]
+        session = sessions.get(id)
+        if session is None:
+            if not len(inner):  # сессия уже закрыта
+                return
+            if len(sessions) >= self.relay_sessions:
+                self.metrics.inc('joins_rejected_total', (('reason', 'relay_full'),))
+                connection.send(pack_relay([id], b''), HIGH_PRIORITY)  # ретранслятор отключит клиента
+                return
+            session = sessions[id] = RelayedConnection(connection, id)
+        relayed_address = tuple(address) + (id,)  # у каждого клиента за ретранслятором свой адрес
+        if not len(inner):  # ретранслятор потерял клиента
+            sessions.pop(id)
+            self.leave(relayed_address, session)
+            session.closed = True
+            return
+        session.bytes_in += len(inner)
+        try:
+            request = decode(inner, session.compression)
+            active = self.handle_request(request, relayed_address, session)
+        except Exception as e:  # испорченный пакет отключает только этого клиента, не весь ретранслятор
+            print(e)
+            self.leave(relayed_address, session)
+            session.close()
+            active = False
+        if not active:
+            sessions.pop(id)
+            session.closed = True
+
+    def leave_relayed(self, address, sessions):  # ретранслятор отключился вместе со всеми своими клиентами
+        for id, session in list(sessions.items()):
+            try:
+                self.leave(tuple(address) + (id,), session)
+            except Exception as e:
+                print(e)
+            session.closed = True
+        sessions.clear()
+
+    def handle_datagram(self, data, address):  # по udp принимаются только пинги, устаревшие отбрасываются
+        res = unpack_datagram(data)
+        registry_lock.acquire()
+        try:
+            client = self.datagrams.get(res[0]) if res is not None else None
+        finally:
+            registry_lock.release()
+        if client is None:
+            self.metrics.inc('datagrams_dropped_total', (('reason', 'unknown'),))
+            return
+        token, seq, prep = res
+        request = decode(prep, client.connection.compression)
+        if request['request'] != PING:
+            self.metrics.inc('datagrams_dropped_total', (('reason', 'request'),))
+            return
+        client.lock.acquire()
+        try:
+            fresh = client.datagram is not None and client.datagram.token == token and client.datagram.accept(seq, address, len(data))
+        finally:
+            client.lock.release()
+        if not fresh:
+            self.metrics.inc('datagrams_dropped_total', (('reason', 'stale'),))
+            return
+        self.metrics.inc('datagrams_total')
+        self.ping(request['data'], client.address, client.connection)
+
+    def datagram_loop(self):
         while self.running:
             try:
-                ready = select.select([client_socket], [], [], 20)
-                if ready[0]:
-                    request = self.receive(client_socket)
-                if not ready[0] or not request:
-                    self.handle_leave(None, address, socket)
+                data, address = self.udp_socket.recvfrom(READ_BUFFER_SIZE)
+                self.handle_datagram(data, address)
+            except OSError:
+                if not self.running:
+                    return
+            except Exception as e:
+                print(e)
+
+    def handle_client_connection(self, client_socket, address, initial=b''):
+        connection = SocketConnection(client_socket)
+        reader = FrameReader(client_socket)
+        reader.feed(initial)  # то, что супервизор успел прочитать до передачи сокета
+        sessions = {}  # если это ретранслятор - клиенты за ним
+        active = True
+        while self.running and active:
+            try:
+                if not reader.has_frame() and not select.select([client_socket], [], [], CLIENT_TIMEOUT)[0]:
+                    self.leave(address, connection)
                     break
-                req = request
-                if req['request'] == LEAVE_REQUEST:
-                    self.handle_leave(None, address, socket)
+                for frame in reader.frames():
+                    connection.bytes_in += HEADER_SIZE + len(frame)
+                    if not self.handle_frame(frame, address, connection, sessions):
+                        active = False
+                        break
+            except Exception as e:
+                print(e)
+                try:
+                    self.leave(address, connection)
+                except Exception:
+                    pass
+                break
+        self.leave_relayed(address, sessions)
+        connection.close()
+
+    async def handle_client_stream(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        connection = StreamConnection(writer, self.loop)
+        sessions = {}
+        while self.running:
+            try:
+                frame = await asyncio.wait_for(self.receive_stream(reader, connection), CLIENT_TIMEOUT)
+                if not await self.loop.run_in_executor(self.executor, self.handle_frame, frame, address, connection, sessions):
                     break
-                data = self.routing[req['request']](req['data'], address, client_socket)
-                if data:
-                    self.send(client_socket, data)
+            except asyncio.CancelledError:  # сервер остановлен
+                break
             except Exception as e:
                 print(e)
                 try:
-                    self.handle_leave(None, address, socket)
+                    await self.loop.run_in_executor(self.executor, self.leave, address, connection)
                 except Exception:
                     pass
                 break
-        try:
-            client_socket.close()
-        except Exception:
-            return
+        await self.loop.run_in_executor(self.executor, self.leave_relayed, address, sessions)
+        connection.close()
 
     def exit(self):
         self.running = False
-        self.socket.close()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.replica.close()
+            self.pool, self.replica = None, None
+        if self.mode != ASYNC_MODE and self.socket is not None:
+            self.socket.close()  # в asyncio режиме сокет закроет сам цикл событий
+            if self.udp_socket is not None:
+                self.udp_socket.close()
 
     def run(self):
         self.running = True
+        if self.metrics_port:
+            app.config['SERVER'] = self
+            threading.Thread(target=app.run, kwargs={'host': self.ip, 'port': self.metrics_port}, daemon=True).start()
+        self.start_replica()
+        if self.mode == ASYNC_MODE:
+            asyncio.run(self.run_async())
+            return
+        threading.Thread(target=self.tick_loop, daemon=True).start()
+        if self.udp_socket is not None:
+            threading.Thread(target=self.datagram_loop, daemon=True).start()
         while self.running:
             try:
-                client_sock, address = self.socket.accept()
+                client_sock, address, initial = self.accept()
                 client_handler = threading.Thread(
                     target=self.handle_client_connection,
-                    args=(client_sock, address)
+                    args=(client_sock, address, initial)
                 )
                 client_handler.start()
             except Exception:
-                pass
+                if self.channel is not None and self.running:
+                    raise  # супервизор пропал - процесс мира больше не нужен
+
+    def accept(self):  # (сокет, адрес, уже прочитанные из него байты)
+        if self.channel is not None:
+            return receive_socket(self.channel)
+        client_sock, address = self.socket.accept()
+        return client_sock, address, b''
+
+    async def adopt_clients(self):  # клиенты от супервизора в asyncio режиме
+        while self.running:
+            client_sock, address, initial = await self.loop.run_in_executor(None, self.accept)
+            reader, writer = await asyncio.open_connection(sock=client_sock)
+            reader.feed_data(initial)
+            self.loop.create_task(self.handle_client_stream(reader, writer))
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(int(os.environ.get("HANDLER_THREADS", HANDLER_THREADS)))
+        tick = asyncio.create_task(self.tick_task())
+        if self.udp_socket is not None:
+            self.datagram_transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: DatagramServer(self), sock=self.udp_socket)
+        if self.channel is not None:
+            await self.adopt_clients()
+            return
+        server = await asyncio.start_server(self.handle_client_stream, sock=self.socket)
+        async with server:
+            while self.running:
+                await asyncio.sleep(0.5)
+        await tick
+
+    def save_world(self):
+        registry_lock.acquire()
+        locks = self.region_locks.acquire_all()
+        try:
+            start = time.perf_counter()
+            self.save()
+            self.metrics.observe('save_seconds', time.perf_counter() - start)
+        finally:
+            self.region_locks.release_all(locks)
+            registry_lock.release()
 
     def listen_cmd(self):
-        print(*['commands:', 'exit', 'save', 'load'])
+        print(*['commands:', 'exit', 'save', 'load', 'locks'])
         while self.running:
             cmd = input()
             if cmd == 'exit':
@@ -304,33 +1124,57 @@ class Server:
                 print('exited')
             elif cmd == 'save':
                 print('saving...')
-                player_lock.acquire()
                 try:
-                    self.save()
+                    self.save_world()
                     print('saved')
                 except Exception as e:
                     print(e)
-                finally:
-                    player_lock.release()
             elif cmd == 'load':
                 print('loading...')
-                player_lock.acquire()
+                registry_lock.acquire()
+                locks = self.region_locks.acquire_all()
                 try:
                     for i in self.player_list.values():
                         try:
-                            i.socket.close()
+                            i.connection.close()
                         except Exception:
                             pass
                     self.load()
+                    if self.replica is not None:
+                        self.replica.reset()
                     print('loaded')
                 except Exception as e:
                     print(e)
                 finally:
-                    player_lock.release()
+                    self.region_locks.release_all(locks)
+                    registry_lock.release()
+            elif cmd == 'locks':  # сколько раз блокировки пришлось ждать
+                for name, (acquired, contended, waited) in self.lock_stats().items():
+                    print(name, acquired, contended, round(waited, 3))
             else:
                 print('unknown command')
 
 
+class DatagramServer(asyncio.DatagramProtocol):  # udp в asyncio режиме
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        self.server.executor.submit(self.handle, data, address)
+
+    def handle(self, data, address):
+        try:
+            self.server.handle_datagram(data, address)
+        except Exception as e:
+            print(e)
+
+
+@app.route('/metrics')
+def metrics_page():
+    server = app.config['SERVER']
+    return flask.Response(server.metrics.render(server.gauges()), mimetype='text/plain; version=0.0.4')
+
+
 def ping():
     timing = time.time()
     while True:
@@ -0,0 +1,34 @@
+import math
+
+# Мир делится на полосы по x, каждой полосой владеет свой процесс сервера.
+# Полоса задается как "начало:конец" (конец не входит), пустая граница - бесконечность.
+# Карта серверов для роутера: "начало:конец=хост:порт,начало:конец=хост:порт,..."
+
+HANDOFF_MARGIN = 4  # столбцов за границей полосы, после которых игрок передается соседу - чтобы не метался на границе
+
+
+def parse_band(text):
+    if not text:
+        return -math.inf, math.inf
+    start, end = text.split(':')
+    return float(start) if start else -math.inf, float(end) if end else math.inf
+
+
+def parse_shards(text):  # [((начало, конец), (хост, порт)), ...]
+    res = []
+    for i in text.split(','):
+        band, address = i.strip().split('=')
+        host, port = address.rsplit(':', 1)
+        res.append((parse_band(band), (host, int(port))))
+    return res
+
+
+def in_band(band, x, margin=0):
+    return band[0] - margin <= x < band[1] + margin
+
+
+def find_shard(shards, x):  # адрес сервера, владеющего столбцом x
+    for band, address in shards:
+        if in_band(band, x):
+            return address
+    return None
@@ -0,0 +1,36 @@
+class SpatialIndex:  # игроки, разложенные по корзинам сетки, для быстрого поиска соседей
+    def __init__(self, cell_size=16):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.positions = {}
+
+    def get_cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def update(self, key, x, y):
+        cell = self.get_cell(x, y)
+        if key in self.positions and self.positions[key][0] != cell:
+            self.discard(key)
+        if key not in self.positions:
+            self.cells.setdefault(cell, set()).add(key)
+        self.positions[key] = (cell, x, y)
+
+    def discard(self, key):
+        if key not in self.positions:
+            return
+        cell = self.positions.pop(key)[0]
+        self.cells[cell].discard(key)
+        if not self.cells[cell]:
+            self.cells.pop(cell)
+
+    def query(self, x0, y0, x1, y1):  # все ключи внутри прямоугольника
+        res = []
+        cx0, cy0 = self.get_cell(x0, y0)
+        cx1, cy1 = self.get_cell(x1, y1)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                for key in self.cells.get((cx, cy), ()):
+                    x, y = self.positions[key][1:]
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        res.append(key)
+        return res
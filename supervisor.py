@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from constants import *
+from connection import FrameReader, HEADER_SIZE, send_socket
+from protocol import encode, decode
+
+# Супервизор слушает один порт, читает запрос на вход и отдает сокет процессу мира, указанного в запросе.
+# Каждый мир - отдельный процесс Server со своим файлом сохранения, упавший процесс перезапускается
+# и поднимает мир из последнего сохранения.
+
+JOIN_TIMEOUT = 20  # секунд на запрос входа
+RESTART_DELAY = 1  # секунд между перезапусками упавшего мира
+AUTOSAVE_TIME = 300  # секунд между сохранениями мира
+CONTEXT = multiprocessing.get_context('spawn')  # мир не наследует слушающий сокет и потоки супервизора
+
+
+def run_world(world, channel, metrics_port):  # тело процесса мира
+    os.environ['METRICS_PORT'] = str(metrics_port)  # переменные окружения у всех миров общие
+    os.environ['SAVE_FILE'] = 'save_' + world + '.txt'
+    from server import Server
+    server = Server(0, channel=channel)
+    if os.path.exists(server.save_path):
+        server.load()
+    threading.Thread(target=autosave, args=(server,), daemon=True).start()
+    server.run()
+
+
+def autosave(server):
+    while server.running:
+        time.sleep(AUTOSAVE_TIME)
+        try:
+            server.save_world()
+        except Exception as e:
+            print(e)
+
+
+class World:  # процесс мира и канал, по которому ему передаются сокеты
+    def __init__(self, name, metrics_port):
+        self.name = name
+        self.metrics_port = metrics_port
+        self.process = None
+        self.channel = None
+        self.lock = threading.Lock()  # сокеты передаются по одному
+        self.restarts = 0
+
+    def start(self):
+        self.channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.process = CONTEXT.Process(target=run_world, args=(self.name, child, self.metrics_port))  # не демон: у мира бывают помощники
+        self.process.start()
+        child.close()
+
+    def pass_client(self, client_socket, address, initial):
+        self.lock.acquire()
+        try:
+            send_socket(self.channel, client_socket, address, initial)
+        finally:
+            self.lock.release()
+
+
+class Supervisor:
+    def __init__(self, port, worlds, isLocal=True):
+        self.port = int(os.environ.get("PORT", port))
+        names = [i.strip() for i in os.environ.get("WORLDS", worlds).split(',') if i.strip()]
+        metrics_port = int(os.environ.get("METRICS_PORT", 0))  # мир i отдает /metrics на METRICS_PORT + i
+        self.worlds = {name: World(name, metrics_port + ind if metrics_port else 0) for ind, name in enumerate(names)}
+        self.default = names[0]
+        self.ip = '127.0.0.1' if isLocal else '0.0.0.0'
+        print(self.ip, self.port, *names)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((self.ip, self.port))
+        self.socket.listen(40)
+        self.running = True
+
+    def route(self, client_socket, address):  # читает вход и отдает сокет миру
+        try:
+            client_socket.settimeout(JOIN_TIMEOUT)
+            reader = FrameReader(client_socket)
+            frame = reader.read()
+            initial = len(frame).to_bytes(HEADER_SIZE, 'big') + bytes(frame) + reader.pending()
+            request = decode(frame, None)  # до входа сжатие не согласовано
+            client_socket.settimeout(None)
+            name = None
+            if request['request'] == JOIN_REQUEST:
+                name = request['data'].get('world') or self.default
+            if name not in self.worlds:
+                prep = encode({'success': False, 'reason': '[server connection error]: Unknown world ' + str(name)})
+                client_socket.sendall(len(prep).to_bytes(HEADER_SIZE, 'big') + prep)
+                return
+            self.worlds[name].pass_client(client_socket, address, initial)
+        except Exception as e:
+            print(e)
+        finally:
+            client_socket.close()  # у процесса мира своя копия
+
+    def watch(self):  # перезапускает упавшие миры
+        while self.running:
+            for world in self.worlds.values():
+                if not world.process.is_alive():
+                    print('world', world.name, 'exited with', world.process.exitcode, '- restarting')
+                    world.channel.close()
+                    world.restarts += 1
+                    world.start()
+            time.sleep(RESTART_DELAY)
+
+    def run(self):
+        for world in self.worlds.values():
+            world.start()
+        threading.Thread(target=self.watch, daemon=True).start()
+        while self.running:
+            try:
+                client_sock, address = self.socket.accept()
+                threading.Thread(target=self.route, args=(client_sock, address), daemon=True).start()
+            except Exception:
+                pass
+
+    def exit(self):
+        self.running = False
+        self.socket.close()
+        for world in self.worlds.values():
+            world.process.terminate()
+
+
+if __name__ == '__main__':
+    supervisor = Supervisor(4400, 'main', isLocal=False)
+    supervisor.run()
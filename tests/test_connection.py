@@ -0,0 +1,98 @@
+import socket
+import threading
+import time
+import pytest
+from connection import FrameReader, HEADER_SIZE, RELAY_HEAD, pack_relay, unpack_relay
+from protocol import MAX_FRAME, RELAY_MARK
+
+
+def frame(payload):
+    return len(payload).to_bytes(HEADER_SIZE, 'big') + payload
+
+
+def pair():
+    a, b = socket.socketpair()
+    return a, b, FrameReader(b, size=64)
+
+
+def test_several_frames_in_one_recv():
+    a, b, reader = pair()
+    a.sendall(frame(b'one') + frame(b'two') + frame(b'three'))
+    assert [bytes(i) for i in reader.frames()] == [b'one', b'two', b'three']
+
+
+def test_split_header():
+    a, b, reader = pair()
+    data = frame(b'payload')
+    a.sendall(data[:5])
+    res = []
+
+    def read():
+        res.append(bytes(reader.read()))
+    thread = threading.Thread(target=read)
+    thread.start()
+    time.sleep(0.05)
+    a.sendall(data[5:])
+    thread.join(1)
+    assert res == [b'payload']
+
+
+def test_frame_spanning_reads():
+    a, b, reader = pair()
+    payload = bytes(range(256)) * 10  # больше буфера читателя
+    data = frame(payload)
+    res = []
+    thread = threading.Thread(target=lambda: res.append(bytes(reader.read())))
+    thread.start()
+    for i in range(0, len(data), 100):
+        a.sendall(data[i:i + 100])
+        time.sleep(0.001)
+    thread.join(1)
+    assert res == [payload]
+    a.sendall(frame(b'after'))  # буфер вернулся к обычному размеру и читает дальше
+    assert bytes(reader.read()) == b'after'
+
+
+def test_frames_survive_buffer_compaction():
+    a, b, reader = pair()
+    a.sendall(frame(b'x' * 30) + frame(b'y' * 30)[:20])
+    assert [bytes(i) for i in reader.frames()] == [b'x' * 30]
+    a.sendall(frame(b'y' * 30)[20:] + frame(b'z'))
+    assert bytes(reader.read()) == b'y' * 30
+    assert bytes(reader.read()) == b'z'
+
+
+def test_feed_initial_bytes():
+    a, b, reader = pair()
+    data = frame(b'join') + frame(b'ping')
+    reader.feed(data[:HEADER_SIZE + 4 + 3])  # то, что прочитал супервизор до передачи сокета
+    assert bytes(reader.read()) == b'join'
+    a.sendall(data[HEADER_SIZE + 4 + 3:])
+    assert bytes(reader.read()) == b'ping'
+    assert reader.pending() == b''
+
+
+def test_closed_socket_raises():
+    a, b, reader = pair()
+    a.sendall(frame(b'last'))
+    a.close()
+    assert bytes(reader.read()) == b'last'
+    with pytest.raises(ConnectionError):
+        reader.read()
+
+
+def test_oversized_frame_is_refused():
+    a, b, reader = pair()
+    a.sendall((MAX_FRAME + 1).to_bytes(HEADER_SIZE, 'big') + b'x' * 10)
+    with pytest.raises(ConnectionError):
+        reader.read()
+
+
+def test_relay_envelope_round_trip():
+    ids, priority, inner = unpack_relay(pack_relay([3, 7], b'payload', 1))
+    assert list(ids) == [3, 7] and priority == 1 and bytes(inner) == b'payload'
+
+
+def test_relay_envelope_without_sessions_is_refused():
+    with pytest.raises(ValueError):
+        unpack_relay(RELAY_HEAD.pack(RELAY_MARK, 0, 0) + b'payload')
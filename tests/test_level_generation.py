@@ -0,0 +1,57 @@
+from constants import REGION_SIZE
+from level_generation import ChunkController
+
+
+class Block:
+    def __init__(self, type):
+        self.type = type
+
+    def on_place(self, game):
+        pass
+
+
+class Server:
+    is_server = True
+
+
+def controller():
+    return ChunkController(8, 8, 1)
+
+
+def fresh_hash(chunk_controller, region):  # без накопленных xor, по самим изменениям
+    chunk_controller.hashes.pop(region, None)
+    return chunk_controller.region_hash(region)
+
+
+def controller_with(chunk_controller):
+    res = controller()
+    res.changes = {x: dict(column) for x, column in chunk_controller.changes.items()}
+    return res
+
+
+def test_place_block_keeps_hash():
+    chunk_controller = controller()
+    chunk_controller.region_hash(0)
+    chunk_controller.place_block(1, 2, Block('stone'), Server())
+    chunk_controller.place_block(1, 2, Block('dirt'), Server())
+    chunk_controller.place_block(3, 4, Block('empty'), Server())
+    assert chunk_controller.region_hash(0) == fresh_hash(controller_with(chunk_controller), 0)
+
+
+def test_predicted_edit_then_ack_matches_server():
+    server, client = controller(), controller()
+    server.place_block(5, 10, Block('stone'), Server())
+    client.place_block(5, 10, Block('stone'), Server())
+    assert client.region_hash(0) == server.region_hash(0)
+    client.set_change(5, 10, Block('empty'))  # предсказанное разрушение
+    server.place_block(5, 10, Block('empty'), Server())
+    client.place_block(5, 10, Block('empty'), Server())  # подтверждение с тем же блоком
+    assert client.region_hash(0) == server.region_hash(0) == fresh_hash(controller_with(server), 0)
+
+
+def test_change_outside_region_keeps_its_hash():
+    chunk_controller = controller()
+    before = chunk_controller.region_hash(0)
+    chunk_controller.set_change(REGION_SIZE, 0, Block('stone'))
+    assert chunk_controller.region_hash(0) == before
+    assert chunk_controller.region_hash(1) == fresh_hash(controller_with(chunk_controller), 1)
@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+import pytest
+import limits
+from constants import *
+from limits import TokenBucket, RATE_LIMITS, make_buckets
+from connection import QueuedConnection, HEADER_SIZE
+from metrics import Metrics
+from protocol import decode
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    res = Clock()
+    monkeypatch.setattr(limits.time, 'monotonic', res)
+    return res
+
+
+def test_burst_then_empty(clock):
+    bucket = TokenBucket(10, 5)
+    assert [bucket.take() for i in range(6)] == [True] * 5 + [False]
+
+
+def test_refill_rate(clock):
+    bucket = TokenBucket(8, 5)
+    for i in range(5):
+        bucket.take()
+    clock.now += 0.3125  # 2.5 токена
+    assert [bucket.take() for i in range(3)] == [True, True, False]
+    clock.now += 0.0625  # еще половина - вместе с остатком ровно один
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_refill_is_capped_by_burst(clock):
+    bucket = TokenBucket(10, 5)
+    bucket.take()
+    clock.now += 100
+    assert sum(bucket.take() for i in range(20)) == 5
+
+
+def test_every_limit_has_a_bucket():
+    assert set(make_buckets()) == set(RATE_LIMITS)
+
+
+class EmptyBlock:
+    def save(self):
+        return {'type': 'empty'}
+
+
+def frames(connection):
+    data = connection.take()
+    res = []
+    while data:
+        ln = int.from_bytes(data[:HEADER_SIZE], 'big')
+        res.append(decode(data[HEADER_SIZE:HEADER_SIZE + ln]))
+        data = data[HEADER_SIZE + ln:]
+    return res
+
+
+def test_rate_limited_edit_is_rejected(clock):
+    from server import Server, ClientInstance
+    server = Server.__new__(Server)  # без сокетов и мира: нужен только разбор запроса
+    server.metrics = Metrics()
+    server.outgoing = deque()
+    server.broadcast_lock = threading.Lock()
+    connection = QueuedConnection()
+    address = ('127.0.0.1', 1)
+    server.player_list = {'a': ClientInstance('a', connection, address, None, 0)}
+    server.player_address = {address: 'a'}
+    handled = []
+
+    def block_destroy(data, address, connection):
+        handled.append(data['seq'])
+        return server.edit_result(data, True, EmptyBlock(), [])
+    server.routing = {DESTROY_BLOCK: block_destroy}
+    rate, burst = RATE_LIMITS[DESTROY_BLOCK]
+    for i in range(burst + 2):
+        server.handle_request({'request': DESTROY_BLOCK, 'data': {'x': 1, 'y': 2, 'seq': i}}, address, connection)
+    assert handled == list(range(burst))
+    acks = [i['data'] for i in frames(connection) if i['request'] == EDIT_ACK]
+    assert [(i['seq'], i['ok']) for i in acks] == [(i, True) for i in range(burst)] + [(burst, False), (burst + 1, False)]
+    assert acks[-1]['block'] is None and acks[-1]['items'] == []
+    clock.now += 2 / rate
+    server.handle_request({'request': DESTROY_BLOCK, 'data': {'x': 1, 'y': 2, 'seq': 99}}, address, connection)
+    assert handled[-1] == 99  # токен вернулся
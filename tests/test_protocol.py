@@ -0,0 +1,133 @@
+import random
+import zlib
+import pytest
+from constants import *
+from protocol import encode, decode, BINARY_CODEC, JSON_CODEC, BINARY_MARK, COMPRESSED_MARK, BINARY_MESSAGES, COMPRESSION, ZDICT, MAX_FRAME, POSITION_SCALE, \
+    STATE_FIELDS, FULL_STATE, quantise_state, restore_state, make_delta, apply_delta
+
+
+def block(type='stone', drop=None):
+    res = {'type': type, 'hp': 3.0, 'transparent': False, 'lighting': 0.5, 'is_phys': True, 'worldpos': [100003, -7]}
+    if drop is not None:
+        res['drop'] = drop
+    return res
+
+
+def state(x=100000.5, y=-3.25, moving=True, dir=1, selected='dirt', vx=0.5, vy=-1.0):
+    return quantise_state({'x': x, 'y': y, 'moving': moving, 'dir': dir, 'selected': selected, 'vx': vx, 'vy': vy})
+
+
+SAMPLES = {  # код бинарного сообщения -> сообщение, которое им кодируется
+    1: {'request': PING, 'data': {'x': 1.5, 'y': -2.25, 'dir': 1, 'moving': True, 'selected': 3}},
+    2: {'request': PING, 'data': {'id': 7, 'x': 1.5, 'y': -2.25, 'dir': -1, 'moving': False, 'selected': 'dirt'}},
+    3: {'request': PLACE_BLOCK, 'data': {'x': 100000, 'y': -5}},
+    4: {'request': DESTROY_BLOCK, 'data': {'x': -100000, 'y': 40}},
+    5: {'request': BLOCK_UPDATE, 'data': {'x': 100003, 'y': -7, 'block': block()}},
+    6: {'request': BLOCK_UPDATE, 'data': {'x': 100003, 'y': -7, 'block': block('grass', ['dirt', 1, 2])}},
+    7: {'request': JOIN, 'data': {'id': 1, 'x': 100000.0, 'y': 12.75, 'name': 'Игрок', 'selected': 'None'}},
+    8: {'request': LEAVE, 'data': {'id': 3}},
+    9: {'request': LEAVE_REQUEST, 'data': {}},
+    10: {'request': SNAPSHOT, 'data': {'seq': 12, 'base': -1, 'time': 1234.5, 'change': 4000000000,
+                                       'players': [make_delta(1, None, state()), make_delta(2, state(), state(x=100001))],
+                                       'blocks': [[None, {'request': BLOCK_UPDATE, 'data': {'x': 1, 'y': 2, 'block': block()}}],
+                                                  [2, {'request': LEAVE, 'data': {'id': 5}}]]}},
+    11: {'request': ACK, 'data': {'seq': 9}},
+    12: {'request': ECHO, 'data': {'id': 1, 'time': 0.25}},
+    13: {'request': PING, 'data': {'x': 1.5, 'y': -2.25, 'dir': 0, 'moving': False, 'selected': 1, 'vx': 0.5, 'vy': -1.0}},
+    14: {'request': PLACE_BLOCK, 'data': {'x': 5, 'y': 6, 'seq': 70000}},
+    15: {'request': DESTROY_BLOCK, 'data': {'x': 5, 'y': 6, 'seq': 1}},
+}
+
+
+def test_every_binary_message_has_a_sample():
+    assert sorted(SAMPLES) == sorted(i.code for i in BINARY_MESSAGES)
+
+
+@pytest.mark.parametrize('code', sorted(SAMPLES))
+def test_binary_matches_json(code):
+    message = SAMPLES[code]
+    prep = encode(message, BINARY_CODEC)
+    assert prep[0] == BINARY_MARK and prep[1] == code
+    assert decode(prep) == decode(encode(message, JSON_CODEC)) == message
+
+
+def test_responses_stay_json():
+    response = {'success': True, 'seed': 5}
+    assert encode(response, BINARY_CODEC) == encode(response, JSON_CODEC)
+
+
+def test_snapshot_head():
+    data = SAMPLES[10]['data']
+    for base, change in [(-1, 0), (63, 1), (2 ** 31 - 1, 2 ** 32 - 1)]:
+        body = dict(data, base=base, change=change)
+        res = decode(encode({'request': SNAPSHOT, 'data': body}, BINARY_CODEC))['data']
+        assert (res['seq'], res['base'], res['time'], res['change']) == (12, base, 1234.5, change)
+
+
+def test_quantisation():
+    data = {'x': 100000 + 1 / 3, 'y': -2.7, 'moving': 1, 'dir': -1, 'selected': 'dirt', 'vx': 0.01, 'vy': -3.333}
+    quantised = quantise_state(data)
+    restored = restore_state(4, quantised)
+    for i in ['x', 'y', 'vx', 'vy']:
+        assert abs(restored[i] - data[i]) <= 0.5 / POSITION_SCALE
+    assert restored['id'] == 4 and restored['moving'] is True
+    assert quantise_state(restored) == quantised  # повторное квантование ничего не меняет
+
+
+def test_full_state_delta():
+    new = state()
+    entry = make_delta(1, None, new)
+    assert entry['mask'] == FULL_STATE | ((1 << len(STATE_FIELDS)) - 1)
+    assert apply_delta(None, entry) == new
+
+
+def test_unchanged_state_has_no_delta():
+    assert make_delta(1, state(), state()) is None
+
+
+def test_delta_masks():
+    old = state()
+    entry = make_delta(1, old, state(x=100002.5))
+    assert entry == {'id': 1, 'mask': 1, 'x': 2 * POSITION_SCALE}  # x передается разницей
+    entry = make_delta(1, old, state(selected='stone', moving=False))
+    assert entry == {'id': 1, 'mask': (1 << 2) | (1 << 4), 'moving': False, 'selected': 'stone'}
+    assert apply_delta(old, entry) == state(selected='stone', moving=False)
+
+
+def test_delta_chain_through_codec():
+    rnd = random.Random(1)
+    base = state()
+    current = base
+    received = base
+    for step in range(200):
+        old = current
+        current = state(x=100000 + rnd.uniform(-50, 50), y=rnd.uniform(-60, 60), moving=rnd.random() < 0.5,
+                        dir=rnd.choice([-1, 1]), selected=rnd.choice(['dirt', 'stone', 'None']),
+                        vx=rnd.uniform(-5, 5), vy=rnd.uniform(-5, 5)) if step % 3 else old
+        entry = make_delta(1, old, current)
+        if entry is None:
+            continue
+        snapshot = {'request': SNAPSHOT, 'data': {'seq': step, 'base': step - 1, 'time': 0.0, 'change': 0,
+                                                  'players': [entry], 'blocks': []}}
+        received = apply_delta(received, decode(encode(snapshot, BINARY_CODEC))['data']['players'][0])
+        assert received == current
+
+
+def test_compressed_round_trip():
+    message = {'request': REGION, 'data': {'region': 3, 'changes': {str(i): {'type': 'stone'} for i in range(200)}}}
+    prep = encode(message, JSON_CODEC, COMPRESSION)
+    assert prep[0] == COMPRESSED_MARK
+    assert decode(prep) == message
+
+
+def test_compressed_needs_negotiation():
+    prep = encode({'request': ECHO, 'data': {'text': 'x' * 1000}}, JSON_CODEC, COMPRESSION)
+    with pytest.raises(ValueError):
+        decode(prep, None)
+
+
+def test_compression_bomb_is_bounded():
+    packer = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, zdict=ZDICT)
+    bomb = bytes([COMPRESSED_MARK]) + packer.compress(b'{"a": "' + b'x' * (MAX_FRAME * 4)) + packer.flush()
+    with pytest.raises(ValueError):
+        decode(bomb)
@@ -0,0 +1,60 @@
+import json
+import os
+import pytest
+from replica import RegionReplica, ReplicaReader, read_log, segment_name, SEGMENT_SIZE
+
+
+@pytest.fixture
+def replica(request):
+    res = RegionReplica('test_replica_' + str(os.getpid()) + '_' + request.node.name[-20:])
+    yield res
+    res.close()
+
+
+def record(column, cells):
+    return json.dumps({column: cells}).encode()
+
+
+def test_publish_and_append(replica):
+    reader = ReplicaReader(replica.prefix)
+    replica.publish(3, record(48, {'1': {'type': 'stone'}}))
+    replica.append(3, record(48, {'2': {'type': 'dirt'}}))
+    replica.append(3, record(48, {'1': {'type': 'empty'}}))
+    version, payload = reader.read(3)
+    assert version == replica.version(3)
+    assert read_log(payload) == {'48': {'1': {'type': 'empty'}, '2': {'type': 'dirt'}}}
+
+
+def test_growth_keeps_first_and_current_generation(replica):
+    reader = ReplicaReader(replica.prefix)
+    replica.publish(0, record(0, {}))
+    for i in range(SEGMENT_SIZE // 8):  # журнал перерастает несколько сегментов
+        replica.append(0, record(i % 16, {str(i): {'type': 'stone'}}))
+    chain = replica.segments[0]
+    assert len(chain) == 2 and chain[0].generation == 0 and chain[-1].generation > 1
+    for generation in range(1, chain[-1].generation):  # промежуточные поколения удалены
+        assert reader.attach(0, generation) is None
+    changes = read_log(reader.read(0)[1])
+    assert sum(len(i) for i in changes.values()) == SEGMENT_SIZE // 8
+
+
+def test_evicted_region_is_gone_until_published_again(replica):
+    reader = ReplicaReader(replica.prefix)
+    replica.publish(5, record(80, {'1': {'type': 'stone'}}))
+    for i in range(SEGMENT_SIZE // 8):
+        replica.append(5, record(80, {str(i): {'type': 'dirt'}}))
+    replica.evict(5)
+    assert 5 not in replica.segments and 5 not in replica.published
+    assert reader.read(5) is None
+    assert reader.attach(5, 0) is None
+    replica.publish(5, record(81, {'2': {'type': 'dirt'}}))
+    assert read_log(reader.read(5)[1]) == {'81': {'2': {'type': 'dirt'}}}
+
+
+def test_close_unlinks_everything(replica):
+    reader = ReplicaReader(replica.prefix)
+    for region in range(4):
+        replica.publish(region, record(region * 16, {}))
+    replica.close()
+    assert not replica.segments
+    assert all(reader.attach(region, 0) is None for region in range(4))